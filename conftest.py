@@ -2,53 +2,121 @@
 Общие фикстуры для всех тестов проекта revenge-calc
 """
 import asyncio
+import sys
+import types
 from datetime import datetime, timezone, timedelta
 from unittest.mock import Mock, AsyncMock
 
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
 import models
 from database import Base
 
-
-@pytest.fixture(scope="session")
-def event_loop():
-    """Создает event loop для всей сессии тестирования"""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
+# Легковесная заглушка ccxt вместо настоящей библиотеки: тесты не обращаются
+# к биржам, а импорт ccxt регистрирует сотни классов бирж. Устанавливается
+# до импорта exchange_service тестовыми модулями.
+CCXT_EXCHANGES = ('binance', 'okx', 'bybit', 'gate')
+# Атрибуты экземпляра биржи ccxt, которые используют сервисы
+CCXT_EXCHANGE_ATTRS = ('id', 'fetch_ohlcv')
+ccxt_stub = types.ModuleType('ccxt')
+ccxt_stub.Exchange = object
+for _exchange_name in CCXT_EXCHANGES:
+    # spec_set: обращение к несуществующему атрибуту - ошибка, а не новый мок
+    setattr(ccxt_stub, _exchange_name, Mock(spec_set=[]))
+sys.modules['ccxt'] = ccxt_stub
+
+# Фабрика тестовых сессий создается один раз, соединение передается при вызове
+TestingSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    # Тесты читают только что записанные объекты - перечитывать их после commit не нужно
+    expire_on_commit=False,
+    join_transaction_mode="create_savepoint"
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_ccxt_mocks():
+    """Сбрасывает классы бирж заглушки ccxt перед каждым тестом"""
+    for exchange_name in CCXT_EXCHANGES:
+        exchange_class = getattr(ccxt_stub, exchange_name)
+        exchange_class.reset_mock(side_effect=True)
+        exchange_class.return_value = Mock(spec_set=CCXT_EXCHANGE_ATTRS)
 
 
 @pytest.fixture
-def test_db_engine():
-    """Создает тестовый движок базы данных"""
+def fake_ccxt():
+    """Заглушка модуля ccxt, через которую тесты проверяют создание бирж"""
+    return ccxt_stub
+
+
+@pytest.fixture(scope="session")
+def db_engine(worker_id):
+    """
+    Создает движок тестовой БД и схему один раз на всю сессию.
+
+    Каждый воркер pytest-xdist получает собственную именованную БД в памяти.
+    """
     engine = create_engine(
-        "sqlite:///:memory:",
+        f"sqlite:///file:revenge_test_{worker_id}?mode=memory&cache=shared&uri=true",
         echo=False,
-        connect_args={
-            "check_same_thread": False,
-            "isolation_level": None
-        },
+        connect_args={"check_same_thread": False},
+        # Одно DBAPI-соединение на всю сессию - без повторного открытия БД
         poolclass=StaticPool
     )
+
+    @event.listens_for(engine, "connect")
+    def _configure_connection(dbapi_connection, _connection_record):
+        # pysqlite сам расставляет BEGIN и ломает SAVEPOINT - отключаем
+        dbapi_connection.isolation_level = None
+        # Тестовая БД одноразовая - синхронизация и журнал на диске не нужны
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.execute("PRAGMA journal_mode=MEMORY")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        # Тесты проверяют FK-ограничения - в SQLite они выключены по умолчанию
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _emit_begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
     Base.metadata.create_all(engine)
-    return engine
+    yield engine
+    engine.dispose()
 
 
 @pytest.fixture
-def test_db_session(test_db_engine):
-    """Создает сессию тестовой базы данных"""
-    testing_session_local = sessionmaker(
-        autocommit=False,
-        autoflush=False,
-        bind=test_db_engine
-    )
-    session = testing_session_local()
+def test_db(db_engine):
+    """
+    Создает сессию тестовой БД внутри внешней транзакции.
+
+    commit()/rollback() в тесте работают с SAVEPOINT, а внешняя транзакция
+    откатывается после теста - схема не пересоздается для каждого теста.
+    """
+    connection = db_engine.connect()
+    transaction = connection.begin()
+    session = TestingSessionLocal(bind=connection)
     yield session
     session.close()
+    transaction.rollback()
+    connection.close()
+
+
+@pytest.fixture
+def test_db_engine(db_engine):
+    """Возвращает общий движок тестовой БД (StaticPool, схема уже создана)"""
+    return db_engine
+
+
+@pytest.fixture
+def test_db_session(test_db):
+    """Создает сессию тестовой базы данных поверх общего движка"""
+    return test_db
 
 
 @pytest.fixture
@@ -265,7 +333,7 @@ def mock_session_local():
     return Mock()
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def mock_data_collection_service():
     """Мок для data_collection_service"""
     mock_service = Mock()
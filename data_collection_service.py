@@ -4,9 +4,13 @@
 Содержит класс DataCollectionService для автоматического сбора
 текущих и исторических данных о свечах.
 """
+import asyncio
 import logging
+from functools import lru_cache
+from types import MappingProxyType
 from datetime import datetime, timezone, timedelta
-from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, selectinload
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
@@ -18,6 +22,61 @@ from logging_config import clean_old_logs
 
 logger = logging.getLogger(__name__)
 
+# Диалектные INSERT с поддержкой ON CONFLICT DO UPDATE
+_UPSERT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+# Соответствие длительности периода в минутах таймфрейму ccxt
+MINUTES_TO_TIMEFRAME = MappingProxyType({
+    1: '1m',
+    3: '3m',
+    5: '5m',
+    15: '15m',
+    30: '30m',
+    60: '1h',
+    120: '2h',
+    240: '4h',
+    360: '6h',
+    480: '8h',
+    720: '12h',
+    1440: '1d',
+    10080: '1w',
+    43200: '1M'
+})
+
+# Число свечей в одном INSERT при сохранении исторических данных
+HISTORICAL_BATCH_SIZE = 1000
+
+# Естественный ключ свечи (см. models.Candle, uq_candle_natural)
+CANDLE_NATURAL_KEY = ('currency_pair_id', 'exchange_id', 'time_period_id', 'open_time')
+
+
+def _candle_upsert_set(stmt) -> dict:
+    """Колонки, обновляемые при конфликте по естественному ключу"""
+    return {
+        column.name: stmt.excluded[column.name]
+        for column in models.Candle.__table__.c
+        if column.name not in ('id', 'created_at')
+    }
+
+
+@lru_cache(maxsize=None)
+def _candle_upsert_stmt(dialect_name: str):
+    """
+    Параметризованный upsert свечи, один объект на диалект.
+
+    Повторное использование одного и того же объекта позволяет SQLAlchemy
+    брать скомпилированный SQL из кэша вместо повторной компиляции.
+    Список строк выполняется как executemany - драйвер собирает их
+    в многострочные INSERT (insertmanyvalues).
+    """
+    stmt = _UPSERT_INSERTS[dialect_name](models.Candle.__table__)
+    return stmt.on_conflict_do_update(
+        index_elements=CANDLE_NATURAL_KEY, set_=_candle_upsert_set(stmt)
+    )
+
 
 class DataCollectionService:
     """
@@ -27,8 +86,24 @@ class DataCollectionService:
     о свечах с настраиваемым расписанием.
     """
 
-    def __init__(self):
-        self.scheduler = AsyncIOScheduler()
+    def __init__(self, scheduler: AsyncIOScheduler = None):
+        self.scheduler = scheduler if scheduler is not None else AsyncIOScheduler()
+        # exchange.id -> asyncio.Lock, сериализует запросы к одной бирже
+        self._fetch_locks = {}
+
+    def _fetch_lock(self, exchange) -> asyncio.Lock:
+        """
+        Блокировка запросов к бирже.
+
+        Экземпляр ccxt синхронный, запросы к нему выполняются в потоках
+        executor'а, а его ограничитель частоты (enableRateLimit) не
+        потокобезопасен: параллельные вызовы проходят пачкой в обход
+        rateLimit. Задачи планировщика (текущие и исторические свечи) могут
+        выполняться одновременно и обращаться к одному экземпляру, поэтому
+        к одной бирже одновременно идет один запрос, а паузы между ними
+        выдерживает сам ccxt. Разные биржи не блокируют друг друга.
+        """
+        return self._fetch_locks.setdefault(exchange.id, asyncio.Lock())
 
     def _get_currency_pair_id(self, db: Session, symbol: str) -> int:
         """Получает currency_pair_id по символу (например BTC/USDT)"""
@@ -95,9 +170,9 @@ class DataCollectionService:
         self.scheduler.start()
         logger.info("Scheduler started successfully")
 
-    def stop_scheduler(self):
+    def stop_scheduler(self, wait: bool = True):
         """Останавливает планировщик задач"""
-        self.scheduler.shutdown()
+        self.scheduler.shutdown(wait=wait)
         logger.info("Scheduler stopped")
 
     async def collect_current_candles(self):
@@ -131,7 +206,11 @@ class DataCollectionService:
             'exchanges': db.query(models.Exchange).filter(
                 models.Exchange.is_active.is_(True)
             ).all(),
-            'currency_pairs': db.query(models.CurrencyPair).filter(
+            # Символы пар нужны при обработке каждой пары - грузим их сразу
+            'currency_pairs': db.query(models.CurrencyPair).options(
+                selectinload(models.CurrencyPair.base_symbol),
+                selectinload(models.CurrencyPair.quote_symbol)
+            ).filter(
                 models.CurrencyPair.is_active.is_(True)
             ).all(),
             'time_periods': db.query(models.TimePeriod).filter(
@@ -193,9 +272,10 @@ class DataCollectionService:
             if not timeframe:
                 return
 
-            candle_data = await exchange_service.fetch_current_candle(
-                exchange_instance, symbol, timeframe
-            )
+            async with self._fetch_lock(exchange):
+                candle_data = await exchange_service.fetch_current_candle(
+                    exchange_instance, symbol, timeframe
+                )
             if candle_data:
                 self._save_or_update_candle(
                     db, exchange, time_period, symbol, candle_data
@@ -207,55 +287,43 @@ class DataCollectionService:
                 symbol, exchange.name, timeframe, e
             )
 
+    def _build_candle_row(self, currency_pair_id: int, exchange, time_period,
+                          candle_data: dict, now: datetime) -> dict:
+        """Формирует строку таблицы candles из данных свечи биржи"""
+        return {
+            'currency_pair_id': currency_pair_id,
+            'exchange_id': exchange.id,
+            'time_period_id': time_period.id,
+            'open_time': candle_data['timestamp'],
+            # Для свечей с биржи open_time = close_time
+            'close_time': candle_data['timestamp'],
+            'open_price': candle_data['open'],
+            'high_price': candle_data['high'],
+            'low_price': candle_data['low'],
+            'close_price': candle_data['close'],
+            'volume': candle_data['volume'],
+            'quote_volume': candle_data.get('quote_volume', 0),
+            'trades_count': candle_data.get('trades_count', 0),
+            'created_at': now,
+            'updated_at': now,
+        }
+
     def _save_or_update_candle(self, db: Session, exchange, time_period,
                                symbol: str, candle_data: dict):
-        """Сохраняет или обновляет свечу в базе данных"""
+        """Сохраняет или обновляет свечу в базе данных одним upsert-запросом"""
         try:
             currency_pair_id = self._get_currency_pair_id(db, symbol)
+            row = self._build_candle_row(
+                currency_pair_id, exchange, time_period, candle_data,
+                models.utcnow()
+            )
 
-            existing_candle = db.query(models.Candle).filter(
-                models.Candle.currency_pair_id == currency_pair_id,
-                models.Candle.exchange_id == exchange.id,
-                models.Candle.time_period_id == time_period.id,
-                models.Candle.open_time == candle_data['timestamp']
-            ).first()
-
-            if not existing_candle:
-                new_candle = models.Candle(
-                    currency_pair_id=currency_pair_id,
-                    exchange_id=exchange.id,
-                    time_period_id=time_period.id,
-                    open_time=candle_data['timestamp'],
-                    # Для текущих свечей open_time = close_time
-                    close_time=candle_data['timestamp'],
-                    open_price=candle_data['open'],
-                    high_price=candle_data['high'],
-                    low_price=candle_data['low'],
-                    close_price=candle_data['close'],
-                    volume=candle_data['volume'],
-                    quote_volume=candle_data.get('quote_volume', 0),
-                    trades_count=candle_data.get('trades_count', 0)
-                )
-                db.add(new_candle)
-                db.commit()
-                logger.debug(
-                    "Added new candle for %s on %s at %s",
-                    symbol, exchange.name, candle_data['timestamp']
-                )
-            else:
-                existing_candle.open_price = candle_data['open']
-                existing_candle.high_price = candle_data['high']
-                existing_candle.low_price = candle_data['low']
-                existing_candle.close_price = candle_data['close']
-                existing_candle.volume = candle_data['volume']
-                existing_candle.quote_volume = candle_data.get('quote_volume', 0)
-                existing_candle.trades_count = candle_data.get('trades_count', 0)
-                existing_candle.updated_at = datetime.now(timezone.utc)
-                db.commit()
-                logger.debug(
-                    "Updated existing candle for %s on %s at %s",
-                    symbol, exchange.name, candle_data['timestamp']
-                )
+            db.execute(_candle_upsert_stmt(db.get_bind().dialect.name), [row])
+            db.commit()
+            logger.debug(
+                "Upserted candle for %s on %s at %s",
+                symbol, exchange.name, candle_data['timestamp']
+            )
         except Exception as e:
             db.rollback()
             logger.error(
@@ -266,23 +334,7 @@ class DataCollectionService:
 
     def convert_minutes_to_timeframe(self, minutes: int) -> str:
         """Конвертирует минуты в таймфрейм ccxt"""
-        timeframe_map = {
-            1: '1m',
-            3: '3m',
-            5: '5m',
-            15: '15m',
-            30: '30m',
-            60: '1h',
-            120: '2h',
-            240: '4h',
-            360: '6h',
-            480: '8h',
-            720: '12h',
-            1440: '1d',
-            10080: '1w',
-            43200: '1M'
-        }
-        return timeframe_map.get(minutes)
+        return MINUTES_TO_TIMEFRAME.get(minutes)
 
     async def collect_historical_candles(self):
         """Собирает исторические свечи с бирж"""
@@ -378,11 +430,21 @@ class DataCollectionService:
                 db, symbol, exchange.id, time_period.id, start_date
             )
 
+            # Диапазоны загружаются по очереди: запросы к бирже все равно идут
+            # по одному (см. _fetch_lock), а сохранение выполняется синхронно
+            # в общей сессии. Ошибка в одном диапазоне не прерывает остальные.
             for start_time, end_time in missing_ranges:
-                await self._collect_candles_for_range(
-                    db, exchange, exchange_instance, symbol,
-                    time_period, timeframe, start_time, end_time
-                )
+                try:
+                    await self._collect_candles_for_range(
+                        db, exchange, exchange_instance, symbol,
+                        time_period, timeframe, start_time, end_time
+                    )
+                except Exception as e:
+                    logger.error(
+                        "Error collecting historical candles for %s on %s %s "
+                        "between %s and %s: %s",
+                        symbol, exchange.name, timeframe, start_time, end_time, e
+                    )
 
         except Exception as e:
             logger.error(
@@ -399,9 +461,10 @@ class DataCollectionService:
         current_time = start_time
 
         while current_time < end_time:
-            historical_candles = await exchange_service.fetch_historical_candles(
-                exchange_instance, symbol, timeframe, current_time, limit=1000
-            )
+            async with self._fetch_lock(exchange):
+                historical_candles = await exchange_service.fetch_historical_candles(
+                    exchange_instance, symbol, timeframe, current_time, limit=1000
+                )
 
             if not historical_candles:
                 break
@@ -423,53 +486,52 @@ class DataCollectionService:
                 )
 
     def _save_historical_candles(self, db: Session, exchange, time_period,
-                                 symbol: str, candles_data: list):
-        """Сохраняет список исторических свечей"""
+                                 symbol: str, candles_data: list,
+                                 batch_size: int = HISTORICAL_BATCH_SIZE):
+        """
+        Сохраняет список исторических свечей upsert-запросами
+        по batch_size строк и фиксирует их одной транзакцией
+        """
+        if not candles_data:
+            return
+
         currency_pair_id = self._get_currency_pair_id(db, symbol)
-        saved_count = 0
+        now = models.utcnow()
+        rows = []
         for candle_data in candles_data:
             try:
-                existing_candle = db.query(models.Candle).filter(
-                    models.Candle.currency_pair_id == currency_pair_id,
-                    models.Candle.exchange_id == exchange.id,
-                    models.Candle.time_period_id == time_period.id,
-                    models.Candle.open_time == candle_data['timestamp']
-                ).first()
-
-                if not existing_candle:
-                    new_candle = models.Candle(
-                        currency_pair_id=currency_pair_id,
-                        exchange_id=exchange.id,
-                        time_period_id=time_period.id,
-                        open_time=candle_data['timestamp'],
-                        # Для исторических данных тоже используем одно время
-                        close_time=candle_data['timestamp'],
-                        open_price=candle_data['open'],
-                        high_price=candle_data['high'],
-                        low_price=candle_data['low'],
-                        close_price=candle_data['close'],
-                        volume=candle_data['volume'],
-                        quote_volume=candle_data.get('quote_volume', 0),
-                        trades_count=candle_data.get('trades_count', 0)
-                    )
-                    db.add(new_candle)
-                    db.commit()  # Сразу сохраняем каждую свечу
-                    saved_count += 1
-            except Exception as e:
-                db.rollback()
+                rows.append(self._build_candle_row(
+                    currency_pair_id, exchange, time_period, candle_data, now
+                ))
+            except KeyError as e:
+                # Свеча без обязательного поля пропускается, остальные сохраняются
                 logger.error(
-                    "Error saving historical candle for %s on %s at %s: %s",
+                    "Error saving historical candle for %s on %s at %s: missing %s",
                     symbol, exchange.name,
                     candle_data.get('timestamp', 'unknown'), e
                 )
-                # Продолжаем сохранение остальных свечей
-                continue
 
-        if saved_count > 0:
-            logger.debug(
-                "Saved %d historical candles for %s on %s",
-                saved_count, symbol, exchange.name
+        if not rows:
+            return
+
+        stmt = _candle_upsert_stmt(db.get_bind().dialect.name)
+
+        try:
+            for start in range(0, len(rows), batch_size):
+                db.execute(stmt, rows[start:start + batch_size])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(
+                "Error saving historical candles for %s on %s: %s",
+                symbol, exchange.name, e
             )
+            return
+
+        logger.debug(
+            "Saved %d historical candles for %s on %s",
+            len(rows), symbol, exchange.name
+        )
 
     def cleanup_old_logs(self):
         """Очищает старые файлы логов"""
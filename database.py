@@ -8,6 +8,7 @@ import os
 
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 # Load environment variables from .env file
@@ -19,11 +20,18 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
+# Пакетная вставка: до 10 000 строк в одном INSERT ... VALUES
+engine_options = {"insertmanyvalues_page_size": 10_000}
+if make_url(DATABASE_URL).get_driver_name() == "psycopg2":
+    # Остальные executemany (UPDATE/DELETE) - через execute_batch
+    engine_options["executemany_mode"] = "values_plus_batch"
+
 # Create SQLAlchemy engine
 engine = create_engine(
     DATABASE_URL,
     pool_pre_ping=True,
-    echo=True  # Set to False in production
+    echo=True,  # Set to False in production
+    **engine_options
 )
 
 # Create SessionLocal class
@@ -21,6 +21,15 @@ logger = logging.getLogger(__name__)
 class ExchangeService:
     """Сервис для работы с криптовалютными биржами."""
 
+    # Поддерживаемые биржи: код биржи -> класс ccxt
+    _FACTORIES = {
+        'binance': ccxt.binance,
+        'binance_testnet': ccxt.binance,
+        'okx': ccxt.okx,
+        'bybit': ccxt.bybit,
+        'gate': ccxt.gate,
+    }
+
     def __init__(self):
         """Инициализирует сервис."""
         self.exchanges = {}
@@ -69,16 +78,8 @@ class ExchangeService:
         if exchange_id not in self.exchanges:
             exchange_code = exchange.code.lower()
 
-            # Поддерживаемые биржи
-            if exchange_code in ('binance', 'binance_testnet'):
-                exchange_class = ccxt.binance
-            elif exchange_code == 'okx':
-                exchange_class = ccxt.okx
-            elif exchange_code == 'bybit':
-                exchange_class = ccxt.bybit
-            elif exchange_code == 'gate':
-                exchange_class = ccxt.gate
-            else:
+            exchange_class = self._FACTORIES.get(exchange_code)
+            if exchange_class is None:
                 raise ValueError(f"Unsupported exchange: {exchange_code}")
 
             # Создаем экземпляр биржи
@@ -12,9 +12,10 @@ from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from sqlalchemy import text
+from sqlalchemy import func, select, text
 from sqlalchemy.orm import Session
 
+import models
 from database import get_db, get_engine
 from data_collection_service import data_collection_service
 from logging_config import setup_logging, get_log_files_info
@@ -38,6 +39,42 @@ async def lifespan(app: FastAPI):
     data_collection_service.stop_scheduler()
 
 
+class HealthShortcut:
+    """
+    ASGI middleware, отвечающий на GET/HEAD /health до маршрутизации FastAPI.
+
+    Балансировщики опрашивают /health каждые несколько секунд, поэтому
+    ответ отдается сразу, минуя остальные middleware и сериализацию.
+    Остальные методы (POST, OPTIONS для CORS preflight и т.д.) проходят
+    в приложение как обычно.
+    """
+
+    METHODS = ("GET", "HEAD")
+
+    BODY = b'{"status":"healthy"}'
+    HEADERS = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(BODY)).encode()),
+    ]
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http" and scope["path"] == "/health"
+                and scope["method"] in self.METHODS):
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": self.HEADERS,
+            })
+            # На HEAD отдаются только заголовки
+            body = b"" if scope["method"] == "HEAD" else self.BODY
+            await send({"type": "http.response.body", "body": body})
+            return
+        await self.app(scope, receive, send)
+
+
 app = FastAPI(
     title="Revenge Calculator API",
     description="A FastAPI application for collecting cryptocurrency market data",
@@ -54,6 +91,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Добавляется последним, чтобы быть внешним слоем стека middleware
+app.add_middleware(HealthShortcut)
+
 # Mount static files
 if os.path.exists("static"):
     app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -146,14 +186,15 @@ async def get_statistics(db: Session = Depends(get_db)):
         total_pairs = db.execute(text("SELECT COUNT(*) FROM currency_pairs")).scalar()
         total_periods = db.execute(text("SELECT COUNT(*) FROM time_periods")).scalar()
 
-        # Последние обновления по биржам
-        latest_updates = db.execute(text("""
-            SELECT e.name as exchange_name, MAX(c.created_at) as last_update
-            FROM candles c
-            JOIN exchanges e ON c.exchange_id = e.id
-            GROUP BY e.id, e.name
-            ORDER BY last_update DESC
-        """)).fetchall()
+        # Последние обновления по биржам. Типизированный MAX(created_at)
+        # возвращает datetime на любом диалекте (в SQLite - не строку)
+        last_update = func.max(models.Candle.created_at).label("last_update")
+        latest_updates = db.execute(
+            select(models.Exchange.name.label("exchange_name"), last_update)
+            .join(models.Candle, models.Candle.exchange_id == models.Exchange.id)
+            .group_by(models.Exchange.id, models.Exchange.name)
+            .order_by(last_update.desc())
+        ).mappings()
 
         return {
             "total_candles": total_candles,
@@ -162,9 +203,9 @@ async def get_statistics(db: Session = Depends(get_db)):
             "total_time_periods": total_periods,
             "latest_updates": [
                 {
-                    "exchange": row[0],
-                    "last_update": (row[1] if isinstance(row[1], str)
-                                  else (row[1].isoformat() if row[1] else None))
+                    "exchange": row["exchange_name"],
+                    "last_update": (row["last_update"].isoformat()
+                                    if row["last_update"] is not None else None)
                 }
                 for row in latest_updates
             ]
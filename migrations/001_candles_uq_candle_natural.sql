@@ -0,0 +1,28 @@
+-- Уникальный естественный ключ свечи для upsert (INSERT ... ON CONFLICT)
+--
+-- DataCollectionService сохраняет свечи запросом
+--   ON CONFLICT (currency_pair_id, exchange_id, time_period_id, open_time)
+-- PostgreSQL требует для этого уникальный индекс по тем же колонкам, иначе
+-- каждое сохранение падает с "no unique or exclusion constraint matching
+-- the ON CONFLICT specification". Таблицы приложение само не создает,
+-- поэтому скрипт нужно применить до запуска новой версии сервиса:
+--
+--   psql "$DATABASE_URL" -f migrations/001_candles_uq_candle_natural.sql
+--
+-- Скрипт идемпотентен: повторный запуск ничего не меняет.
+
+BEGIN;
+
+-- Удаляем дубликаты по естественному ключу, оставляя самую позднюю запись
+DELETE FROM candles older
+USING candles newer
+WHERE older.currency_pair_id = newer.currency_pair_id
+  AND older.exchange_id = newer.exchange_id
+  AND older.time_period_id = newer.time_period_id
+  AND older.open_time = newer.open_time
+  AND older.id < newer.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_candle_natural
+    ON candles (currency_pair_id, exchange_id, time_period_id, open_time);
+
+COMMIT;
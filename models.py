@@ -5,13 +5,21 @@
 включая пользователей, биржи, символы, валютные пары, временные периоды,
 свечи и конфигурации бирж.
 """
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Numeric, Boolean
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Column, Integer, String, DateTime, ForeignKey, Numeric, Boolean, UniqueConstraint
+)
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import functions
 
 from database import Base
 
 
+def utcnow() -> datetime:
+    """Текущее время в UTC для created_at/updated_at."""
+    return datetime.now(timezone.utc)
+
+
 class User(Base):
     """Модель пользователя системы."""
 
@@ -23,8 +31,8 @@ class User(Base):
     email_verified_at = Column(DateTime)
     password = Column(String, nullable=False)
     remember_token = Column(String)
-    created_at = Column(DateTime, server_default=functions.now())
-    updated_at = Column(DateTime, server_default=functions.now(), onupdate=functions.now())
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
 
 class Exchange(Base):
@@ -40,8 +48,8 @@ class Exchange(Base):
     api_secret = Column(String)
     api_passphrase = Column(String)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, server_default=functions.now())
-    updated_at = Column(DateTime, server_default=functions.now(), onupdate=functions.now())
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
 
 class Symbol(Base):
@@ -54,8 +62,8 @@ class Symbol(Base):
     symbol = Column(String, nullable=False, unique=True)
     description = Column(String)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, server_default=functions.now())
-    updated_at = Column(DateTime, server_default=functions.now(), onupdate=functions.now())
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
 
 class CurrencyPair(Base):
@@ -68,8 +76,8 @@ class CurrencyPair(Base):
     quote_symbol_id = Column(Integer, ForeignKey("symbols.id"))
     type = Column(String, nullable=False)  # spot/futures
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, server_default=functions.now())
-    updated_at = Column(DateTime, server_default=functions.now(), onupdate=functions.now())
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
     # Relationships
     base_symbol = relationship("Symbol", foreign_keys=[base_symbol_id])
@@ -86,14 +94,21 @@ class TimePeriod(Base):
     minutes = Column(Integer, nullable=False)
     description = Column(String)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, server_default=functions.now())
-    updated_at = Column(DateTime, server_default=functions.now(), onupdate=functions.now())
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
 
 class Candle(Base):
     """Модель свечи с данными OHLCV."""
 
     __tablename__ = "candles"
+    __table_args__ = (
+        # Естественный ключ свечи - используется для upsert (ON CONFLICT)
+        UniqueConstraint(
+            "currency_pair_id", "exchange_id", "time_period_id", "open_time",
+            name="uq_candle_natural"
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     currency_pair_id = Column(Integer, ForeignKey("currency_pairs.id"))
@@ -108,8 +123,8 @@ class Candle(Base):
     volume = Column(Numeric(precision=18, scale=8))
     quote_volume = Column(Numeric(precision=18, scale=8))
     trades_count = Column(Integer)
-    created_at = Column(DateTime, server_default=functions.now())
-    updated_at = Column(DateTime, server_default=functions.now(), onupdate=functions.now())
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
     # Relationships
     currency_pair = relationship("CurrencyPair")
@@ -128,8 +143,8 @@ class ExchangeConfiguration(Base):
     api_key = Column(String)
     api_secret = Column(String)
     sandbox_mode = Column(Boolean, default=False)
-    created_at = Column(DateTime, server_default=functions.now())
-    updated_at = Column(DateTime, server_default=functions.now(), onupdate=functions.now())
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
     # Relationships
     exchange = relationship("Exchange")
@@ -8,9 +8,10 @@ from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from sqlalchemy import text
+from sqlalchemy import func, select, text
 from sqlalchemy.orm import Session
 
+import models
 from database import engine, get_db
 from logging_config import setup_logging
 
@@ -105,14 +106,15 @@ async def get_statistics(db: Session = Depends(get_db)):
         total_pairs = db.execute(text("SELECT COUNT(*) FROM currency_pairs")).scalar()
         total_periods = db.execute(text("SELECT COUNT(*) FROM time_periods")).scalar()
 
-        # Последние обновления по биржам
-        latest_updates = db.execute(text("""
-            SELECT e.name as exchange_name, MAX(c.created_at) as last_update
-            FROM candles c
-            JOIN exchanges e ON c.exchange_id = e.id
-            GROUP BY e.id, e.name
-            ORDER BY last_update DESC
-        """)).fetchall()
+        # Последние обновления по биржам. Типизированный MAX(created_at)
+        # возвращает datetime на любом диалекте (в SQLite - не строку)
+        last_update = func.max(models.Candle.created_at).label("last_update")
+        latest_updates = db.execute(
+            select(models.Exchange.name.label("exchange_name"), last_update)
+            .join(models.Candle, models.Candle.exchange_id == models.Exchange.id)
+            .group_by(models.Exchange.id, models.Exchange.name)
+            .order_by(last_update.desc())
+        ).mappings()
 
         return {
             "total_candles": total_candles,
@@ -121,11 +123,9 @@ async def get_statistics(db: Session = Depends(get_db)):
             "total_time_periods": total_periods,
             "latest_updates": [
                 {
-                    "exchange": row[0],
-                    "last_update": (
-                        row[1].isoformat() if row[1] and hasattr(row[1], 'isoformat') 
-                        else str(row[1]) if row[1] else None
-                    )
+                    "exchange": row["exchange_name"],
+                    "last_update": (row["last_update"].isoformat()
+                                    if row["last_update"] is not None else None)
                 }
                 for row in latest_updates
             ]
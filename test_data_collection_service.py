@@ -4,27 +4,77 @@
 Содержит тесты для проверки функциональности сбора текущих и исторических
 данных о свечах с различных бирж.
 """
-import math
-from datetime import datetime, timezone
+import asyncio
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from types import SimpleNamespace
 from unittest.mock import Mock, AsyncMock, patch
-from sqlalchemy.orm import Session
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy import event
 import pytest
 
 import models
-from database import Base
 from data_collection_service import DataCollectionService, data_collection_service
 from exchange_service import exchange_service
 
+# Время открытия первой тестовой свечи
+BASE_TIME = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def seed(db, *, exchanges=(), symbols=(), periods=(), pairs=()):
+    """Записывает справочные данные пакетно, одним коммитом"""
+    db.bulk_insert_mappings(models.Exchange, exchanges)
+    db.bulk_insert_mappings(models.Symbol, symbols)
+    db.bulk_insert_mappings(models.TimePeriod, periods)
+    db.bulk_insert_mappings(models.CurrencyPair, pairs)
+    db.commit()
+
+
+# Стандартный набор для тестов: биржа, BTC/USDT и минутный период
+TEST_EXCHANGE = {
+    'id': 1, 'name': "Test Exchange", 'code': "test", 'environment': "sandbox",
+    'api_key': "test_key", 'api_secret': "test_secret", 'is_active': True
+}
+TEST_SYMBOLS = (
+    {'id': 1, 'name': "Bitcoin", 'symbol': "BTC", 'is_active': True},
+    {'id': 2, 'name': "Tether", 'symbol': "USDT", 'is_active': True},
+)
+TEST_PERIOD = {'id': 1, 'name': "1 minute", 'minutes': 1, 'is_active': True}
+TEST_PAIR = {'id': 1, 'base_symbol_id': 1, 'quote_symbol_id': 2, 'type': "spot", 'is_active': True}
+
+
+def seed_btc_usdt(db, exchange=None):
+    """Заполняет БД стандартным набором и возвращает биржу, период и пару"""
+    if exchange is None:
+        exchange = TEST_EXCHANGE
+    seed(db, exchanges=[exchange], symbols=TEST_SYMBOLS,
+         periods=[TEST_PERIOD], pairs=[TEST_PAIR])
+    return (
+        db.get(models.Exchange, exchange['id']),
+        db.get(models.TimePeriod, TEST_PERIOD['id']),
+        db.get(models.CurrencyPair, TEST_PAIR['id']),
+    )
+
+
+class FakeSession:
+    """Заглушка сессии БД для тестов, которым нужны только commit/rollback/close"""
+
+    __slots__ = ('commit', 'rollback', 'close', 'query')
+
+    def __init__(self):
+        self.commit = Mock()
+        self.rollback = Mock()
+        self.close = Mock()
+        self.query = Mock()
+        self.query.return_value.filter.return_value.all.return_value = []
+
 
 @pytest.fixture
-def test_db():
-    """Создает тестовую базу данных в памяти"""
-    engine = create_engine("sqlite:///:memory:", echo=False)
-    Base.metadata.create_all(engine)
-    testing_session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    return testing_session_local()
+def fake_session():
+    """Создает заглушку сессии БД без интроспекции класса Session"""
+    return FakeSession()
 
 
 @pytest.fixture
@@ -42,6 +92,20 @@ def mock_exchange():
     return exchange
 
 
+@pytest.fixture
+def mock_exchange_obj():
+    """Создает легковесный мок биржи для тестов без записи в БД"""
+    return SimpleNamespace(
+        id=1,
+        name="Test Exchange",
+        code="test",
+        environment="sandbox",
+        api_key="test_key",
+        api_secret="test_secret",
+        is_active=True
+    )
+
+
 @pytest.fixture
 def mock_symbol():
     """Создает мок символа"""
@@ -68,7 +132,7 @@ def mock_time_period():
 def sample_candle_data():
     """Создает образец данных свечи"""
     return {
-        'timestamp': datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc),
+        'timestamp': BASE_TIME,
         'open': 50000.0,
         'high': 51000.0,
         'low': 49000.0,
@@ -86,40 +150,23 @@ class TestDataCollectionService:
         assert service.scheduler is not None
         assert service.scheduler.running is False  # Планировщик не запущен по умолчанию
 
-    def test_convert_minutes_to_timeframe(self):
+    @pytest.mark.parametrize("minutes, timeframe", [
+        (1, '1m'),
+        (5, '5m'),
+        (15, '15m'),
+        (60, '1h'),
+        (1440, '1d'),
+        (7, None),  # Неизвестное значение
+    ])
+    def test_convert_minutes_to_timeframe(self, minutes, timeframe):
         """Тестирует конвертацию минут в таймфрейм"""
         service = DataCollectionService()
+        assert service.convert_minutes_to_timeframe(minutes) == timeframe
 
-        # Тестируем известные значения
-        assert service.convert_minutes_to_timeframe(1) == '1m'
-        assert service.convert_minutes_to_timeframe(5) == '5m'
-        assert service.convert_minutes_to_timeframe(15) == '15m'
-        assert service.convert_minutes_to_timeframe(60) == '1h'
-        assert service.convert_minutes_to_timeframe(1440) == '1d'
-
-        # Тестируем неизвестное значение
-        assert service.convert_minutes_to_timeframe(7) is None
-
-    def test_get_active_entities(self, test_db, mock_exchange, mock_time_period):
+    def test_get_active_entities(self, test_db):
         """Тестирует получение активных сущностей"""
         service = DataCollectionService()
-
-        # Создаем символы и валютную пару
-        btc = models.Symbol(name="Bitcoin", symbol="BTC", is_active=True)
-        usdt = models.Symbol(name="Tether", symbol="USDT", is_active=True)
-
-        test_db.add_all([mock_exchange, btc, usdt, mock_time_period])
-        test_db.commit()
-
-        currency_pair = models.CurrencyPair(
-            base_symbol_id=btc.id,
-            quote_symbol_id=usdt.id,
-            type="spot",
-            is_active=True
-        )
-
-        test_db.add(currency_pair)
-        test_db.commit()
+        seed_btc_usdt(test_db)
 
         entities = service._get_active_entities(test_db)
 
@@ -128,6 +175,21 @@ class TestDataCollectionService:
         assert len(entities['time_periods']) == 1
         assert entities['exchanges'][0].name == "Test Exchange"
 
+        # Символы пары загружены заранее - обращение к ним не выполняет запросов
+        statements = []
+
+        def count_statement(_conn, _cursor, statement, *_args):
+            statements.append(statement)
+
+        connection = test_db.connection()
+        event.listen(connection, "before_cursor_execute", count_statement)
+        try:
+            pair = entities['currency_pairs'][0]
+            assert (pair.base_symbol.symbol, pair.quote_symbol.symbol) == ("BTC", "USDT")
+        finally:
+            event.remove(connection, "before_cursor_execute", count_statement)
+        assert statements == []
+
     def test_save_or_update_candle_new(
         self, test_db, mock_exchange, mock_time_period, sample_candle_data
     ):
@@ -162,8 +224,8 @@ class TestDataCollectionService:
         candle = test_db.query(models.Candle).first()
         assert candle is not None
         assert candle.currency_pair_id == currency_pair.id
-        assert math.isclose(candle.open_price, 50000.0, rel_tol=1e-9)
-        assert math.isclose(candle.close_price, 50500.0, rel_tol=1e-9)
+        assert candle.open_price == Decimal("50000.0")
+        assert candle.close_price == Decimal("50500.0")
 
     def test_save_or_update_candle_existing(self, test_db, mock_exchange, mock_time_period, sample_candle_data):
         """Тестирует обновление существующей свечи"""
@@ -188,7 +250,8 @@ class TestDataCollectionService:
         test_db.add(currency_pair)
         test_db.commit()
 
-        # Создаем существующую свечу
+        # Создаем существующую свечу, записанную заведомо раньше upsert
+        written_at = datetime(2020, 1, 1, 0, 0)
         existing_candle = models.Candle(
             currency_pair_id=currency_pair.id,
             exchange_id=mock_exchange.id,
@@ -201,7 +264,9 @@ class TestDataCollectionService:
             close_price=45500.0,
             volume=50.0,
             quote_volume=0,
-            trades_count=0
+            trades_count=0,
+            created_at=written_at,
+            updated_at=written_at
         )
         test_db.add(existing_candle)
         test_db.commit()
@@ -209,39 +274,27 @@ class TestDataCollectionService:
         # Обновляем свечу
         service._save_or_update_candle(test_db, mock_exchange, mock_time_period, "BTC/USDT", sample_candle_data)
 
+        # Upsert идет мимо identity map - перечитываем свечу из БД
+        test_db.expire(existing_candle)
+
         # Проверяем что свеча была обновлена
         candle = test_db.query(models.Candle).first()
-        assert math.isclose(candle.open_price, 50000.0, rel_tol=1e-9)  # Новое значение
-        assert math.isclose(candle.close_price, 50500.0, rel_tol=1e-9)  # Новое значение
-        assert candle.updated_at is not None
-
-    def test_save_historical_candles(self, test_db, mock_exchange, mock_time_period):
+        assert candle.open_price == Decimal("50000.0")  # Новое значение
+        assert candle.close_price == Decimal("50500.0")  # Новое значение
+        assert test_db.query(models.Candle).count() == 1
+        # created_at сохраняется, updated_at сдвигается вперед
+        assert candle.created_at == written_at
+        assert candle.updated_at > written_at
+
+    def test_save_historical_candles(self, test_db, mocker):
         """Тестирует сохранение исторических свечей"""
         service = DataCollectionService()
-
-        # Создаем новые объекты для этого теста
-        btc = models.Symbol(name="Bitcoin", symbol="BTC", is_active=True)
-        usdt = models.Symbol(name="Tether", symbol="USDT", is_active=True)
-
-        # Добавляем зависимые объекты
-        test_db.add_all([mock_exchange, mock_time_period, btc, usdt])
-        test_db.commit()
-
-        # Создаем валютную пару
-        currency_pair = models.CurrencyPair(
-            base_symbol_id=btc.id,
-            quote_symbol_id=usdt.id,
-            type="spot",
-            is_active=True
-        )
-
-        test_db.add(currency_pair)
-        test_db.commit()
+        exchange, time_period, _ = seed_btc_usdt(test_db)
 
         # Создаем список исторических свечей
         candles_data = [
             {
-                'timestamp': datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc),
+                'timestamp': BASE_TIME,
                 'open': 50000.0,
                 'high': 51000.0,
                 'low': 49000.0,
@@ -249,7 +302,7 @@ class TestDataCollectionService:
                 'volume': 100.5
             },
             {
-                'timestamp': datetime(2023, 1, 1, 12, 1, tzinfo=timezone.utc),
+                'timestamp': BASE_TIME + timedelta(minutes=1),
                 'open': 50500.0,
                 'high': 51500.0,
                 'low': 49500.0,
@@ -258,24 +311,60 @@ class TestDataCollectionService:
             }
         ]
 
-        service._save_historical_candles(test_db, mock_exchange, mock_time_period, "BTC/USDT", candles_data)
+        execute_spy = mocker.spy(test_db, 'execute')
+        service._save_historical_candles(test_db, exchange, time_period, "BTC/USDT", candles_data)
         test_db.commit()  # Коммитим изменения
 
+        # Все свечи записываются одним INSERT ... ON CONFLICT
+        inserts = [call for call in execute_spy.call_args_list if call.args[0].is_insert]
+        assert len(inserts) == 1
+
         # Проверяем что свечи были сохранены
         candles = test_db.query(models.Candle).all()
         assert len(candles) == 2
-        assert math.isclose(candles[0].open_price, 50000.0, rel_tol=1e-9)
-        assert math.isclose(candles[1].open_price, 50500.0, rel_tol=1e-9)
+        assert candles[0].open_price == Decimal("50000.0")
+        assert candles[1].open_price == Decimal("50500.0")
+
+    def test_save_historical_candles_in_batches(self, test_db, sample_candles_batch, mocker):
+        """Тестирует пакетное сохранение свечей с одним коммитом"""
+        service = DataCollectionService()
+        exchange, time_period, _ = seed_btc_usdt(test_db)
 
-    @pytest.mark.asyncio
-    async def test_process_timeframe_candle_success(self, test_db, mock_exchange, mock_time_period):
+        execute_spy = mocker.spy(test_db, 'execute')
+        commit_spy = mocker.spy(test_db, 'commit')
+        service._save_historical_candles(
+            test_db, exchange, time_period, "BTC/USDT", sample_candles_batch, batch_size=4
+        )
+
+        # 10 свечей по 4 в пакете - три INSERT и один коммит
+        inserts = [call for call in execute_spy.call_args_list if call.args[0].is_insert]
+        assert len(inserts) == 3
+        commit_spy.assert_called_once()
+        assert test_db.query(models.Candle).count() == 10
+
+    def test_save_historical_candles_skips_malformed(self, test_db, sample_candles_batch, caplog):
+        """Свеча без обязательного поля логируется и пропускается, остальные сохраняются"""
+        service = DataCollectionService()
+        exchange, time_period, _ = seed_btc_usdt(test_db)
+
+        candles_data = [dict(candle) for candle in sample_candles_batch]
+        del candles_data[3]['close']
+
+        service._save_historical_candles(
+            test_db, exchange, time_period, "BTC/USDT", candles_data
+        )
+
+        assert test_db.query(models.Candle).count() == len(candles_data) - 1
+        assert "missing 'close'" in caplog.text
+
+    async def test_process_timeframe_candle_success(self, test_db, mock_exchange_obj, mock_time_period):
         """Тестирует успешную обработку свечи для таймфрейма"""
         service = DataCollectionService()
 
         # Мокаем exchange_service
         mock_exchange_instance = Mock()
         mock_candle_data = {
-            'timestamp': datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc),
+            'timestamp': BASE_TIME,
             'open': 50000.0,
             'high': 51000.0,
             'low': 49000.0,
@@ -287,13 +376,16 @@ class TestDataCollectionService:
             mock_fetch.return_value = mock_candle_data
 
             with patch.object(service, '_save_or_update_candle') as mock_save:
-                await service._process_timeframe_candle(test_db, mock_exchange, mock_exchange_instance, "BTC/USDT", mock_time_period)
+                await service._process_timeframe_candle(
+                    test_db, mock_exchange_obj, mock_exchange_instance, "BTC/USDT", mock_time_period
+                )
 
                 mock_fetch.assert_called_once_with(mock_exchange_instance, "BTC/USDT", "1m")
-                mock_save.assert_called_once_with(test_db, mock_exchange, mock_time_period, "BTC/USDT", mock_candle_data)
+                mock_save.assert_called_once_with(
+                    test_db, mock_exchange_obj, mock_time_period, "BTC/USDT", mock_candle_data
+                )
 
-    @pytest.mark.asyncio
-    async def test_process_timeframe_candle_no_data(self, test_db, mock_exchange, mock_time_period):
+    async def test_process_timeframe_candle_no_data(self, test_db, mock_exchange_obj, mock_time_period):
         """Тестирует обработку свечи когда нет данных"""
         service = DataCollectionService()
         mock_exchange_instance = Mock()
@@ -302,13 +394,14 @@ class TestDataCollectionService:
             mock_fetch.return_value = None
 
             with patch.object(service, '_save_or_update_candle') as mock_save:
-                await service._process_timeframe_candle(test_db, mock_exchange, mock_exchange_instance, "BTC/USDT", mock_time_period)
+                await service._process_timeframe_candle(
+                    test_db, mock_exchange_obj, mock_exchange_instance, "BTC/USDT", mock_time_period
+                )
 
                 mock_fetch.assert_called_once()
                 mock_save.assert_not_called()
 
-    @pytest.mark.asyncio
-    async def test_process_timeframe_candle_invalid_timeframe(self, test_db, mock_exchange):
+    async def test_process_timeframe_candle_invalid_timeframe(self, test_db, mock_exchange_obj):
         """Тестирует обработку свечи с неподдерживаемым таймфреймом"""
         service = DataCollectionService()
         mock_exchange_instance = Mock()
@@ -322,24 +415,25 @@ class TestDataCollectionService:
         )
 
         with patch.object(exchange_service, 'fetch_current_candle', new_callable=AsyncMock) as mock_fetch:
-            await service._process_timeframe_candle(test_db, mock_exchange, mock_exchange_instance, "BTC/USDT", invalid_time_period)
+            await service._process_timeframe_candle(
+                test_db, mock_exchange_obj, mock_exchange_instance, "BTC/USDT", invalid_time_period
+            )
 
             # Не должно вызывать fetch_current_candle для неподдерживаемого таймфрейма
             mock_fetch.assert_not_called()
 
-    @pytest.mark.asyncio
-    async def test_collect_candles_for_range(self, test_db, mock_exchange, mock_time_period):
+    async def test_collect_candles_for_range(self, test_db, mock_exchange_obj, mock_time_period):
         """Тестирует сбор свечей для временного диапазона"""
         service = DataCollectionService()
         mock_exchange_instance = Mock()
 
-        start_time = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
-        end_time = datetime(2023, 1, 1, 13, 0, tzinfo=timezone.utc)
+        start_time = BASE_TIME
+        end_time = BASE_TIME + timedelta(hours=1)
 
         # Мокаем данные свечей
         mock_candles = [
             {
-                'timestamp': datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc),
+                'timestamp': BASE_TIME,
                 'open': 50000.0,
                 'high': 51000.0,
                 'low': 49000.0,
@@ -353,63 +447,38 @@ class TestDataCollectionService:
 
             with patch.object(service, '_save_historical_candles') as mock_save:
                 await service._collect_candles_for_range(
-                    test_db, mock_exchange, mock_exchange_instance,
+                    test_db, mock_exchange_obj, mock_exchange_instance,
                     "BTC/USDT", mock_time_period, "1m", start_time, end_time
                 )
 
                 mock_fetch.assert_called_once_with(mock_exchange_instance, "BTC/USDT", "1m", start_time, limit=1000)
-                mock_save.assert_called_once_with(test_db, mock_exchange, mock_time_period, "BTC/USDT", mock_candles)
-
-    @pytest.mark.asyncio
-    async def test_collect_current_candles_integration(self):
-        """Интеграционный тест сбора текущих свечей"""
-        service = DataCollectionService()
-
-        # Создаем моки для SessionLocal и всех зависимостей
-        mock_db = Mock(spec=Session)
-        mock_db.query.return_value.filter.return_value.all.return_value = []
-        mock_db.commit = Mock()
-        mock_db.rollback = Mock()
-        mock_db.close = Mock()
-
-        with patch('data_collection_service.SessionLocal', return_value=mock_db):
-            with patch.object(service, '_get_active_entities') as mock_get_entities:
-                mock_get_entities.return_value = {
-                    'exchanges': [],
-                    'currency_pairs': [],
-                    'time_periods': []
-                }
-
-                await service.collect_current_candles()
-
-                mock_db.commit.assert_called_once()
-                mock_db.close.assert_called_once()
+                mock_save.assert_called_once_with(
+                    test_db, mock_exchange_obj, mock_time_period, "BTC/USDT", mock_candles
+                )
 
-    @pytest.mark.asyncio
-    async def test_collect_current_candles_with_error(self):
-        """Тестирует обработку ошибок при сборе текущих свечей"""
+    @pytest.mark.parametrize("side_effect, commit_count, rollback_count", [
+        (None, 1, 0),
+        (Exception("Test error"), 0, 1),
+    ], ids=["success", "error"])
+    async def test_collect_current_candles(self, fake_session, side_effect,
+                                           commit_count, rollback_count):
+        """Тестирует сбор текущих свечей: коммит при успехе, откат при ошибке"""
         service = DataCollectionService()
+        entities = {'exchanges': [], 'currency_pairs': [], 'time_periods': []}
 
-        mock_db = Mock(spec=Session)
-        mock_db.rollback = Mock()
-        mock_db.close = Mock()
-
-        with patch('data_collection_service.SessionLocal', return_value=mock_db):
-            with patch.object(service, '_get_active_entities', side_effect=Exception("Test error")):
+        with patch('data_collection_service.SessionLocal', return_value=fake_session):
+            with patch.object(service, '_get_active_entities',
+                              side_effect=side_effect, return_value=entities):
                 await service.collect_current_candles()
 
-                mock_db.rollback.assert_called_once()
-                mock_db.close.assert_called_once()
+        assert fake_session.commit.call_count == commit_count
+        assert fake_session.rollback.call_count == rollback_count
+        fake_session.close.assert_called_once()
 
-    @pytest.mark.asyncio
-    async def test_collect_historical_candles_integration(self):
+    async def test_collect_historical_candles_integration(self, fake_session):
         """Интеграционный тест сбора исторических свечей"""
         service = DataCollectionService()
-
-        mock_db = Mock(spec=Session)
-        mock_db.commit = Mock()
-        mock_db.rollback = Mock()
-        mock_db.close = Mock()
+        mock_db = fake_session
 
         with patch('data_collection_service.SessionLocal', return_value=mock_db):
             with patch.object(service, '_get_active_entities') as mock_get_entities:
@@ -425,10 +494,16 @@ class TestDataCollectionService:
                     mock_db.commit.assert_called_once()
                     mock_db.close.assert_called_once()
 
-    @pytest.mark.asyncio
+    @pytest.mark.xdist_group("scheduler")
     async def test_scheduler_start_stop(self):
         """Тестирует запуск и остановку планировщика"""
-        service = DataCollectionService()
+        # Минимальный планировщик: задачи только в памяти, исполнитель в текущем loop
+        scheduler = AsyncIOScheduler(
+            jobstores={'default': MemoryJobStore()},
+            executors={'default': AsyncIOExecutor()}
+        )
+        service = DataCollectionService(scheduler=scheduler)
+        assert service.scheduler is scheduler
 
         # Тестируем запуск
         service.start_scheduler()
@@ -440,52 +515,35 @@ class TestDataCollectionService:
         assert 'collect_current_candles' in job_ids
         assert 'collect_historical_candles' in job_ids
 
-        # Тестируем остановку
-        service.stop_scheduler()
+        # Тестируем остановку, не дожидаясь завершения выполняющихся задач
+        service.stop_scheduler(wait=False)
 
-        # Даем немного времени для полной остановки
-        await pytest.importorskip("asyncio").sleep(0.1)
+        for _ in range(50):
+            if not service.scheduler.running:
+                break
+            await asyncio.sleep(0.002)
 
         assert not service.scheduler.running
 
-    @pytest.mark.asyncio
-    async def test_process_exchange_candles_error_handling(self, test_db, mock_exchange, mock_time_period):
+    async def test_process_exchange_candles_error_handling(self, test_db):
         """Тестирует обработку ошибок при обработке свечей биржи"""
         service = DataCollectionService()
-
-        # Создаем символы и валютную пару
-        btc = models.Symbol(name="Bitcoin", symbol="BTC", is_active=True)
-        usdt = models.Symbol(name="Tether", symbol="USDT", is_active=True)
-
-        test_db.add_all([mock_exchange, btc, usdt, mock_time_period])
-        test_db.commit()
-
-        currency_pair = models.CurrencyPair(
-            base_symbol_id=btc.id,
-            quote_symbol_id=usdt.id,
-            type="spot",
-            is_active=True
-        )
-        currency_pair.base_symbol = btc
-        currency_pair.quote_symbol = usdt
-
-        test_db.add(currency_pair)
-        test_db.commit()
+        exchange, time_period, currency_pair = seed_btc_usdt(test_db)
 
         with patch.object(exchange_service, 'get_exchange_instance', side_effect=Exception("Exchange error")):
             # Не должно поднимать исключение, только логировать
-            await service._process_exchange_candles(test_db, mock_exchange, [currency_pair], [mock_time_period])
+            await service._process_exchange_candles(test_db, exchange, [currency_pair], [time_period])
 
-    @pytest.mark.asyncio
-    async def test_collect_timeframe_historical_data_with_missing_ranges(self, test_db, mock_exchange, mock_time_period):
+    async def test_collect_timeframe_historical_data_with_missing_ranges(self, test_db, mock_exchange_obj,
+                                                                         mock_time_period):
         """Тестирует сбор исторических данных с отсутствующими диапазонами"""
         service = DataCollectionService()
         mock_exchange_instance = Mock()
 
         start_date = datetime(2023, 1, 1, tzinfo=timezone.utc)
         missing_ranges = [
-            (datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc), datetime(2023, 1, 1, 13, 0, tzinfo=timezone.utc)),
-            (datetime(2023, 1, 1, 14, 0, tzinfo=timezone.utc), datetime(2023, 1, 1, 15, 0, tzinfo=timezone.utc))
+            (BASE_TIME, BASE_TIME + timedelta(hours=1)),
+            (BASE_TIME + timedelta(hours=2), BASE_TIME + timedelta(hours=3))
         ]
 
         with patch.object(exchange_service, 'get_missing_candles_timerange', new_callable=AsyncMock) as mock_missing:
@@ -493,12 +551,69 @@ class TestDataCollectionService:
 
             with patch.object(service, '_collect_candles_for_range', new_callable=AsyncMock) as mock_collect:
                 await service._collect_timeframe_historical_data(
-                    test_db, mock_exchange, mock_exchange_instance,
+                    test_db, mock_exchange_obj, mock_exchange_instance,
                     "BTC/USDT", mock_time_period, "1m", start_date
                 )
 
-                # Проверяем что _collect_candles_for_range вызван для каждого диапазона
-                assert mock_collect.call_count == 2
+                # Проверяем что _collect_candles_for_range вызван для каждого диапазона по порядку
+                collected_ranges = [call.args[-2:] for call in mock_collect.call_args_list]
+                assert collected_ranges == missing_ranges
+
+    async def test_collect_timeframe_historical_data_range_error(self, test_db, mock_exchange_obj,
+                                                                 mock_time_period, caplog):
+        """Ошибка в одном диапазоне логируется и не мешает собрать остальные"""
+        service = DataCollectionService()
+        failing_range = (BASE_TIME, BASE_TIME + timedelta(hours=1))
+        ok_range = (BASE_TIME + timedelta(hours=2), BASE_TIME + timedelta(hours=3))
+        collected = []
+
+        async def collect(*args):
+            if args[-2:] == failing_range:
+                raise RuntimeError("Range error")
+            collected.append(args[-2:])
+
+        with patch.object(exchange_service, 'get_missing_candles_timerange',
+                          new_callable=AsyncMock, return_value=[failing_range, ok_range]):
+            with patch.object(service, '_collect_candles_for_range', side_effect=collect):
+                await service._collect_timeframe_historical_data(
+                    test_db, mock_exchange_obj, Mock(), "BTC/USDT",
+                    mock_time_period, "1m", BASE_TIME
+                )
+
+        assert collected == [ok_range]
+        assert "Range error" in caplog.text
+
+    async def test_historical_and_current_jobs_share_exchange_lock(
+            self, test_db, mock_exchange_obj, mock_time_period):
+        """Одновременные задачи сбора не обращаются к одной бирже параллельно"""
+        service = DataCollectionService()
+        active = 0
+        max_active = 0
+
+        async def fetch(*_args, **_kwargs):
+            nonlocal active, max_active
+            active += 1
+            max_active = max(max_active, active)
+            await asyncio.sleep(0)  # Отдаем управление другой задаче
+            active -= 1
+
+        with patch.object(exchange_service, 'fetch_historical_candles',
+                          side_effect=fetch) as mock_historical, \
+                patch.object(exchange_service, 'fetch_current_candle',
+                             side_effect=fetch) as mock_current:
+            await asyncio.gather(
+                service._collect_candles_for_range(
+                    test_db, mock_exchange_obj, Mock(), "BTC/USDT", mock_time_period,
+                    "1m", BASE_TIME, BASE_TIME + timedelta(hours=1)
+                ),
+                service._process_timeframe_candle(
+                    test_db, mock_exchange_obj, Mock(), "BTC/USDT", mock_time_period
+                ),
+            )
+
+        mock_historical.assert_awaited_once()
+        mock_current.assert_awaited_once()
+        assert max_active == 1
 
 
 class TestDataCollectionServiceSingleton:
@@ -518,41 +633,20 @@ class TestDataCollectionServiceSingleton:
 class TestDataCollectionServiceFunctional:
     """Функциональные тесты для проверки работы сервиса в реальных условиях"""
 
-    @pytest.mark.asyncio
     async def test_full_current_candles_workflow(self, test_db):
         """Функциональный тест полного цикла сбора текущих свечей"""
         service = DataCollectionService()
 
         # Создаем полный набор тестовых данных
-        exchange = models.Exchange(
-            name="Binance", code="binance",
-            environment="sandbox", is_active=True
-        )
-
-        base_symbol = models.Symbol(name="Bitcoin", symbol="BTC", is_active=True)
-        quote_symbol = models.Symbol(name="Tether", symbol="USDT", is_active=True)
-
-        time_period = models.TimePeriod(
-            name="1 minute", minutes=1, is_active=True
-        )
-
-        test_db.add_all([exchange, base_symbol, quote_symbol, time_period])
-        test_db.commit()
-
-        currency_pair = models.CurrencyPair(
-            base_symbol_id=base_symbol.id, quote_symbol_id=quote_symbol.id,
-            type="spot", is_active=True
-        )
-        currency_pair.base_symbol = base_symbol
-        currency_pair.quote_symbol = quote_symbol
-
-        test_db.add(currency_pair)
-        test_db.commit()
+        exchange, time_period, currency_pair = seed_btc_usdt(test_db, exchange={
+            'id': 1, 'name': "Binance", 'code': "binance",
+            'environment': "sandbox", 'is_active': True
+        })
 
         # Мокаем exchange_service
         mock_exchange_instance = Mock()
         mock_candle_data = {
-            'timestamp': datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc),
+            'timestamp': BASE_TIME,
             'open': 50000.0,
             'high': 51000.0,
             'low': 49000.0,
@@ -571,9 +665,8 @@ class TestDataCollectionServiceFunctional:
                 candle = test_db.query(models.Candle).first()
                 assert candle is not None
                 assert candle.currency_pair_id == currency_pair.id
-                assert math.isclose(candle.open_price, 50000.0, rel_tol=1e-9)
+                assert candle.open_price == Decimal("50000.0")
 
-    @pytest.mark.asyncio
     async def test_multiple_timeframes_processing(self, test_db):
         """Тестирует обработку нескольких таймфреймов"""
         service = DataCollectionService()
@@ -612,7 +705,7 @@ class TestDataCollectionServiceFunctional:
 
         with patch.object(exchange_service, 'fetch_current_candle', new_callable=AsyncMock) as mock_fetch:
             mock_fetch.return_value = {
-                'timestamp': datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc),
+                'timestamp': BASE_TIME,
                 'open': 50000.0, 'high': 51000.0, 'low': 49000.0, 'close': 50500.0, 'volume': 100.5
             }
 
@@ -4,47 +4,75 @@
 Содержит тесты для проверки функциональности получения данных с бирж,
 обработки свечей и других операций с биржевыми данными.
 """
-import math
 from datetime import datetime, timezone
 from unittest.mock import Mock, patch
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
 import pytest
 
 import models
-from database import Base
 from exchange_service import ExchangeService, exchange_service
 
+# Начало периода выборки и время открытия первой тестовой свечи
+START_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+BASE_TIME = START_DATE.replace(hour=12)
 
-@pytest.fixture
-def test_db():
-    """Создает тестовую базу данных в памяти"""
-    engine = create_engine(
-        "sqlite:///:memory:",
-        echo=False,
-        poolclass=StaticPool,
-        connect_args={
-            "check_same_thread": False,
-        }
-    )
-    Base.metadata.create_all(engine)
-    testing_session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Свеча OHLCV в формате ccxt: timestamp (мс), open, high, low, close, volume
+BASE_OHLCV_ROW = [int(BASE_TIME.timestamp() * 1000), 50000.0, 51000.0, 49000.0, 50500.0, 100.5]
 
-    db = testing_session_local()
 
-    # Создаем тестовые данные
+@pytest.fixture
+def test_db(test_db):
+    """
+    Тестовая БД с биржей и периодом времени.
+
+    Схема создается один раз за сессию (см. conftest.py), а данные
+    добавляются внутри транзакции теста и откатываются после него.
+    """
     exchange = models.Exchange(
-        id=1, name="Binance", code="binance", 
+        id=1, name="Binance", code="binance",
         environment="production", is_active=True
     )
     time_period = models.TimePeriod(id=1, name="1 minute", minutes=1, description="1 minute")
 
-    db.add(exchange)
-    db.add(time_period)
-    db.commit()
+    test_db.add(exchange)
+    test_db.add(time_period)
+    test_db.commit()
+
+    return test_db
+
+
+@pytest.fixture(scope="module")
+def large_ohlcv():
+    """Создает 1000 минутных свечей OHLCV один раз на модуль"""
+    base_timestamp = BASE_OHLCV_ROW[0]
+    return [
+        [base_timestamp + i * 60000, 50000.0 + i, 51000.0 + i, 49000.0 + i, 50500.0 + i, 100.5]
+        for i in range(1000)
+    ]
+
+
+@pytest.fixture(scope="module")
+def service():
+    """
+    Общий экземпляр сервиса для тестов, не изменяющих его состояние.
+
+    Тесты, создающие экземпляры бирж (кэш service.exchanges),
+    используют собственный ExchangeService().
+    """
+    return ExchangeService()
 
-    return db
+
+@pytest.fixture(scope="module")
+def exchange_instance_stub():
+    """Заглушка экземпляра биржи ccxt, общая для модуля"""
+    # spec_set ограничивает атрибуты: id нужен для логирования ошибок
+    return Mock(spec_set=["id", "fetch_ohlcv"])
+
+
+@pytest.fixture
+def mock_exchange_instance(exchange_instance_stub):
+    """Экземпляр биржи с fetch_ohlcv, сбрасываемый после каждого теста"""
+    yield exchange_instance_stub
+    exchange_instance_stub.fetch_ohlcv.reset_mock(return_value=True, side_effect=True)
 
 
 @pytest.fixture
@@ -86,71 +114,57 @@ class TestExchangeService:
         service = ExchangeService()
         assert not service.exchanges
 
-    def test_get_exchange_instance_binance(self, mock_exchange):
+    def test_get_exchange_instance_binance(self, mock_exchange, fake_ccxt):
         """Тестирует создание экземпляра Binance"""
         service = ExchangeService()
 
-        with patch('ccxt.binance') as mock_binance_class:
-            mock_instance = Mock()
-            mock_binance_class.return_value = mock_instance
-
-            result = service.get_exchange_instance(mock_exchange)
+        result = service.get_exchange_instance(mock_exchange)
 
-            assert result == mock_instance
-            assert service.exchanges[mock_exchange.id] == mock_instance
+        assert result == fake_ccxt.binance.return_value
+        assert service.exchanges[mock_exchange.id] == result
 
-            # Проверяем правильность конфигурации
-            expected_config = {
-                'apiKey': 'test_api_key',
-                'secret': 'test_api_secret',
-                'sandbox': True,
-                'enableRateLimit': True,
-            }
-            mock_binance_class.assert_called_once_with(expected_config)
+        # Проверяем правильность конфигурации
+        expected_config = {
+            'apiKey': 'test_api_key',
+            'secret': 'test_api_secret',
+            'sandbox': True,
+            'enableRateLimit': True,
+        }
+        fake_ccxt.binance.assert_called_once_with(expected_config)
 
-    def test_get_exchange_instance_okx_with_passphrase(self, mock_okx_exchange):
+    def test_get_exchange_instance_okx_with_passphrase(self, mock_okx_exchange, fake_ccxt):
         """Тестирует создание экземпляра OKX с passphrase"""
         service = ExchangeService()
 
-        with patch('ccxt.okx') as mock_okx_class:
-            mock_instance = Mock()
-            mock_okx_class.return_value = mock_instance
+        result = service.get_exchange_instance(mock_okx_exchange)
 
-            result = service.get_exchange_instance(mock_okx_exchange)
+        assert result == fake_ccxt.okx.return_value
 
-            assert result == mock_instance
-
-            # Проверяем что passphrase добавлен как password
-            expected_config = {
-                'apiKey': 'test_api_key',
-                'secret': 'test_api_secret',
-                'sandbox': False,  # production environment
-                'enableRateLimit': True,
-                'password': 'test_passphrase'
-            }
-            mock_okx_class.assert_called_once_with(expected_config)
+        # Проверяем что passphrase добавлен как password
+        expected_config = {
+            'apiKey': 'test_api_key',
+            'secret': 'test_api_secret',
+            'sandbox': False,  # production environment
+            'enableRateLimit': True,
+            'password': 'test_passphrase'
+        }
+        fake_ccxt.okx.assert_called_once_with(expected_config)
 
-    def test_get_exchange_instance_cached(self, mock_exchange):
+    def test_get_exchange_instance_cached(self, mock_exchange, fake_ccxt):
         """Тестирует кэширование экземпляров биржи"""
         service = ExchangeService()
 
-        with patch('ccxt.binance') as mock_binance_class:
-            mock_instance = Mock()
-            mock_binance_class.return_value = mock_instance
-
-            # Первый вызов - создает экземпляр
-            result1 = service.get_exchange_instance(mock_exchange)
+        # Первый вызов - создает экземпляр
+        result1 = service.get_exchange_instance(mock_exchange)
 
-            # Второй вызов - возвращает кэшированный экземпляр
-            result2 = service.get_exchange_instance(mock_exchange)
+        # Второй вызов - возвращает кэшированный экземпляр
+        result2 = service.get_exchange_instance(mock_exchange)
 
-            assert result1 == result2
-            assert mock_binance_class.call_count == 1  # Вызван только один раз
+        assert result1 == result2
+        assert fake_ccxt.binance.call_count == 1  # Вызван только один раз
 
-    def test_get_exchange_instance_unsupported(self):
+    def test_get_exchange_instance_unsupported(self, service):
         """Тестирует обработку неподдерживаемой биржи"""
-        service = ExchangeService()
-
         unsupported_exchange = models.Exchange(
             id=99,
             name="Unsupported Exchange",
@@ -164,170 +178,113 @@ class TestExchangeService:
         with pytest.raises(ValueError, match="Unsupported exchange: unsupported"):
             service.get_exchange_instance(unsupported_exchange)
 
-    def test_get_exchange_instance_bybit(self):
-        """Тестирует создание экземпляра Bybit"""
+    def test_get_exchange_instance_uses_factory_table(self):
+        """Тестирует что класс биржи выбирается по таблице _FACTORIES"""
         service = ExchangeService()
+        kraken_class = Mock(spec_set=[])
 
-        bybit_exchange = models.Exchange(
-            id=3,
-            name="Bybit",
-            code="bybit",
+        kraken_exchange = models.Exchange(
+            id=5,
+            name="Kraken",
+            code="KRAKEN",
             environment="production",
             api_key="test_key",
             api_secret="test_secret",
             is_active=True
         )
 
-        with patch('ccxt.bybit') as mock_bybit_class:
-            mock_instance = Mock()
-            mock_bybit_class.return_value = mock_instance
-
-            result = service.get_exchange_instance(bybit_exchange)
+        with patch.dict(ExchangeService._FACTORIES, {'kraken': kraken_class}):
+            result = service.get_exchange_instance(kraken_exchange)
 
-            assert result == mock_instance
-            mock_bybit_class.assert_called_once()
+        # Код биржи приводится к нижнему регистру перед поиском
+        assert result is kraken_class.return_value
+        kraken_class.assert_called_once()
+        assert 'kraken' not in ExchangeService._FACTORIES
 
-    def test_get_exchange_instance_gate(self):
-        """Тестирует создание экземпляра Gate.io"""
+    @pytest.mark.parametrize("code, name, environment", [
+        ("bybit", "Bybit", "production"),
+        ("gate", "Gate.io", "sandbox"),
+    ])
+    def test_get_exchange_instance_other(self, fake_ccxt, code, name, environment):
+        """Тестирует создание экземпляров Bybit и Gate.io"""
         service = ExchangeService()
 
-        gate_exchange = models.Exchange(
-            id=4,
-            name="Gate.io",
-            code="gate",
-            environment="sandbox",
+        exchange = models.Exchange(
+            id=3,
+            name=name,
+            code=code,
+            environment=environment,
             api_key="test_key",
             api_secret="test_secret",
             is_active=True
         )
 
-        with patch('ccxt.gate') as mock_gate_class:
-            mock_instance = Mock()
-            mock_gate_class.return_value = mock_instance
-
-            result = service.get_exchange_instance(gate_exchange)
+        result = service.get_exchange_instance(exchange)
 
-            assert result == mock_instance
-            mock_gate_class.assert_called_once()
+        exchange_class = getattr(fake_ccxt, code)
+        assert result == exchange_class.return_value
+        exchange_class.assert_called_once()
+        assert exchange_class.call_args.args[0]['sandbox'] == (environment == "sandbox")
 
-    @pytest.mark.asyncio
-    async def test_fetch_current_candle_success(self):
-        """Тестирует успешное получение текущей свечи"""
-        service = ExchangeService()
-
-        mock_exchange_instance = Mock()
-        # Исправляем AsyncMock - делаем синхронный мок для fetch_ohlcv
-        mock_exchange_instance.fetch_ohlcv = Mock(return_value=[
-            [1672574400000, 50000.0, 51000.0, 49000.0, 50500.0, 100.5]  # timestamp, o, h, l, c, v
-        ])
+    @pytest.mark.parametrize("ohlcv, error, expected_open", [
+        ([list(BASE_OHLCV_ROW)], None, 50000.0),
+        ([], None, None),
+        (None, Exception("Network error"), None),
+    ], ids=["success", "no_data", "exception"])
+    async def test_fetch_current_candle(self, service, mock_exchange_instance,
+                                        ohlcv, error, expected_open):
+        """Тестирует получение текущей свечи: данные, пустой ответ и ошибка биржи"""
+        mock_exchange_instance.fetch_ohlcv.return_value = ohlcv
+        mock_exchange_instance.fetch_ohlcv.side_effect = error
 
         result = await service.fetch_current_candle(mock_exchange_instance, "BTC/USDT", "1m")
 
-        assert result is not None
-        assert math.isclose(result['open'], 50000.0, rel_tol=1e-9)
-        assert math.isclose(result['high'], 51000.0, rel_tol=1e-9)
-        assert math.isclose(result['low'], 49000.0, rel_tol=1e-9)
-        assert math.isclose(result['close'], 50500.0, rel_tol=1e-9)
-        assert math.isclose(result['volume'], 100.5, rel_tol=1e-9)
-        assert isinstance(result['timestamp'], datetime)
-
         mock_exchange_instance.fetch_ohlcv.assert_called_once_with("BTC/USDT", "1m", None, 2)
+        if expected_open is None:
+            assert result is None
+            return
+
+        assert result['open'] == expected_open
+        assert result['high'] == 51000.0
+        assert result['low'] == 49000.0
+        assert result['close'] == 50500.0
+        assert result['volume'] == 100.5
+        assert isinstance(result['timestamp'], datetime)
 
-    @pytest.mark.asyncio
-    async def test_fetch_current_candle_no_data(self):
-        """Тестирует получение текущей свечи когда нет данных"""
-        service = ExchangeService()
-
-        mock_exchange_instance = Mock()
-        mock_exchange_instance.fetch_ohlcv = Mock(return_value=[])
-
-        result = await service.fetch_current_candle(mock_exchange_instance, "BTC/USDT", "1m")
-
-        assert result is None
-
-    @pytest.mark.asyncio
-    async def test_fetch_current_candle_exception(self):
-        """Тестирует обработку исключений при получении текущей свечи"""
-        service = ExchangeService()
-
-        mock_exchange_instance = Mock()
-        mock_exchange_instance.fetch_ohlcv = Mock(side_effect=Exception("Network error"))
-
-        result = await service.fetch_current_candle(mock_exchange_instance, "BTC/USDT", "1m")
-
-        assert result is None
-
-    @pytest.mark.asyncio
-    async def test_fetch_historical_candles_success(self):
-        """Тестирует успешное получение исторических свечей"""
-        service = ExchangeService()
-
-        mock_exchange_instance = Mock()
-        mock_data = [
-            [1672574400000, 50000.0, 51000.0, 49000.0, 50500.0, 100.5],
+    @pytest.mark.parametrize("ohlcv, error, limit, expected_opens", [
+        ([
+            list(BASE_OHLCV_ROW),
             [1672574460000, 50500.0, 51500.0, 49500.0, 51000.0, 120.3]
-        ]
-        mock_exchange_instance.fetch_ohlcv = Mock(return_value=mock_data)
-
-        start_time = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
+        ], None, None, [50000.0, 50500.0]),
+        ([], None, 500, []),
+        (None, Exception("API error"), None, []),
+    ], ids=["success", "custom_limit", "exception"])
+    async def test_fetch_historical_candles(self, service, mock_exchange_instance,
+                                            ohlcv, error, limit, expected_opens):
+        """Тестирует получение исторических свечей: данные, лимит и ошибка биржи"""
+        mock_exchange_instance.fetch_ohlcv.return_value = ohlcv
+        mock_exchange_instance.fetch_ohlcv.side_effect = error
+
+        kwargs = {} if limit is None else {'limit': limit}
         result = await service.fetch_historical_candles(
-            mock_exchange_instance, "BTC/USDT", "1m", start_time
+            mock_exchange_instance, "BTC/USDT", "1m", BASE_TIME, **kwargs
         )
 
-        assert len(result) == 2
-        assert math.isclose(result[0]['open'], 50000.0, rel_tol=1e-9)
-        assert math.isclose(result[1]['open'], 50500.0, rel_tol=1e-9)
-
-        # Проверяем правильность передачи параметров
-        expected_since = int(start_time.timestamp() * 1000)
-        mock_exchange_instance.fetch_ohlcv.assert_called_once_with(
-            "BTC/USDT", "1m", expected_since, 1000
-        )
-
-    @pytest.mark.asyncio
-    async def test_fetch_historical_candles_with_custom_limit(self):
-        """Тестирует получение исторических свечей с кастомным лимитом"""
-        service = ExchangeService()
-
-        mock_exchange_instance = Mock()
-        mock_exchange_instance.fetch_ohlcv = Mock(return_value=[])
+        assert [candle['open'] for candle in result] == expected_opens
 
-        start_time = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
-        await service.fetch_historical_candles(
-            mock_exchange_instance, "BTC/USDT", "1m", start_time, limit=500
-        )
-
-        expected_since = int(start_time.timestamp() * 1000)
+        # Проверяем правильность передачи параметров (лимит по умолчанию - 1000)
         mock_exchange_instance.fetch_ohlcv.assert_called_once_with(
-            "BTC/USDT", "1m", expected_since, 500
+            "BTC/USDT", "1m", BASE_OHLCV_ROW[0], limit or 1000
         )
 
-    @pytest.mark.asyncio
-    async def test_fetch_historical_candles_exception(self):
-        """Тестирует обработку исключений при получении исторических свечей"""
-        service = ExchangeService()
-
-        mock_exchange_instance = Mock()
-        mock_exchange_instance.fetch_ohlcv = Mock(side_effect=Exception("API error"))
-
-        start_time = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
-        result = await service.fetch_historical_candles(
-            mock_exchange_instance, "BTC/USDT", "1m", start_time
-        )
-
-        assert result == []
-
-    @pytest.mark.asyncio
-    async def test_get_missing_candles_timerange_no_data(self, test_db):
+    async def test_get_missing_candles_timerange_no_data(self, service, test_db):
         """Тестирует получение отсутствующих диапазонов когда нет данных в БД"""
-        service = ExchangeService()
-
         # Создаем символы и валютную пару
         btc = models.Symbol(name="Bitcoin", symbol="BTC", is_active=True)
         usdt = models.Symbol(name="Tether", symbol="USDT", is_active=True)
 
         test_db.add_all([btc, usdt])
-        test_db.commit()
+        test_db.flush()  # id символов нужны для валютной пары
 
         currency_pair = models.CurrencyPair(
             base_symbol_id=btc.id,
@@ -339,21 +296,16 @@ class TestExchangeService:
         test_db.add(currency_pair)
         test_db.commit()
 
-        start_date = datetime(2023, 1, 1, tzinfo=timezone.utc)
-
-        result = await service.get_missing_candles_timerange(test_db, "BTC/USDT", 1, 1, start_date)
+        result = await service.get_missing_candles_timerange(test_db, "BTC/USDT", 1, 1, START_DATE)
 
         # Должен вернуть один диапазон от start_date до текущего времени
         assert len(result) == 1
-        assert result[0][0] == start_date
+        assert result[0][0] == START_DATE
         # end_date должна быть близка к текущему времени
         assert result[0][1] <= datetime.now(timezone.utc)
 
-    @pytest.mark.asyncio
-    async def test_get_missing_candles_timerange_with_existing_data(self, test_db):
+    async def test_get_missing_candles_timerange_with_existing_data(self, service, test_db):
         """Тестирует получение отсутствующих диапазонов с существующими данными"""
-        service = ExchangeService()
-
         # Создаем символы, валютную пару, биржу и период
         btc = models.Symbol(name="Bitcoin", symbol="BTC", is_active=True)
         usdt = models.Symbol(name="Tether", symbol="USDT", is_active=True)
@@ -361,7 +313,7 @@ class TestExchangeService:
         time_period = models.TimePeriod(name="1m", minutes=1, is_active=True)
 
         test_db.add_all([btc, usdt, exchange, time_period])
-        test_db.commit()
+        test_db.flush()  # id символов нужны для валютной пары
 
         currency_pair = models.CurrencyPair(
             base_symbol_id=btc.id,
@@ -371,16 +323,15 @@ class TestExchangeService:
         )
 
         test_db.add(currency_pair)
-        test_db.commit()
+        test_db.flush()
 
         # Создаем тестовые данные
-        timestamp = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
         existing_candle = models.Candle(
             currency_pair_id=currency_pair.id,
             exchange_id=exchange.id,
             time_period_id=time_period.id,
-            open_time=timestamp,
-            close_time=timestamp,
+            open_time=BASE_TIME,
+            close_time=BASE_TIME,
             open_price=50000.0,
             high_price=51000.0,
             low_price=49000.0,
@@ -392,9 +343,8 @@ class TestExchangeService:
         test_db.add(existing_candle)
         test_db.commit()
 
-        start_date = datetime(2023, 1, 1, tzinfo=timezone.utc)
         result = await service.get_missing_candles_timerange(
-            test_db, "BTC/USDT", exchange.id, time_period.id, start_date
+            test_db, "BTC/USDT", exchange.id, time_period.id, START_DATE
         )
 
         # Должны быть диапазоны до и после существующей свечи
@@ -410,30 +360,25 @@ class TestExchangeService:
 class TestExchangeServiceIntegration:
     """Интеграционные тесты для проверки совместной работы компонентов"""
 
-    @pytest.mark.asyncio
-    async def test_full_workflow_current_candle(self, mock_exchange):
+    async def test_full_workflow_current_candle(self, mock_exchange, fake_ccxt):
         """Интеграционный тест полного цикла получения текущей свечи"""
         service = ExchangeService()
 
-        with patch('ccxt.binance') as mock_binance_class:
-            mock_instance = Mock()
-            mock_instance.fetch_ohlcv = Mock(return_value=[
-                [1672574400000, 50000.0, 51000.0, 49000.0, 50500.0, 100.5]
-            ])
-            mock_binance_class.return_value = mock_instance
+        fake_ccxt.binance.return_value.fetch_ohlcv = Mock(return_value=[
+            list(BASE_OHLCV_ROW)
+        ])
 
-            # Получаем экземпляр биржи
-            exchange_instance = service.get_exchange_instance(mock_exchange)
+        # Получаем экземпляр биржи
+        exchange_instance = service.get_exchange_instance(mock_exchange)
 
-            # Получаем текущую свечу
-            candle_data = await service.fetch_current_candle(exchange_instance, "BTC/USDT", "1m")
+        # Получаем текущую свечу
+        candle_data = await service.fetch_current_candle(exchange_instance, "BTC/USDT", "1m")
 
-            assert candle_data is not None
-            assert math.isclose(candle_data['open'], 50000.0, rel_tol=1e-9)
-            assert math.isclose(candle_data['close'], 50500.0, rel_tol=1e-9)
+        assert candle_data is not None
+        assert candle_data['open'] == 50000.0
+        assert candle_data['close'] == 50500.0
 
-    @pytest.mark.asyncio
-    async def test_multiple_exchanges_support(self):
+    async def test_multiple_exchanges_support(self, fake_ccxt):
         """Тестирует поддержку нескольких бирж одновременно"""
         service = ExchangeService()
 
@@ -448,79 +393,55 @@ class TestExchangeServiceIntegration:
             api_passphrase="pass2", is_active=True
         )
 
-        with patch('ccxt.binance') as mock_binance, patch('ccxt.okx') as mock_okx:
-            mock_binance_instance = Mock()
-            mock_okx_instance = Mock()
-            mock_binance.return_value = mock_binance_instance
-            mock_okx.return_value = mock_okx_instance
-
-            # Создаем экземпляры разных бирж
-            binance_inst = service.get_exchange_instance(binance_exchange)
-            okx_inst = service.get_exchange_instance(okx_exchange)
+        # Создаем экземпляры разных бирж
+        binance_inst = service.get_exchange_instance(binance_exchange)
+        okx_inst = service.get_exchange_instance(okx_exchange)
 
-            assert binance_inst == mock_binance_instance
-            assert okx_inst == mock_okx_instance
-            assert len(service.exchanges) == 2
+        assert binance_inst == fake_ccxt.binance.return_value
+        assert okx_inst == fake_ccxt.okx.return_value
+        assert len(service.exchanges) == 2
 
-    @pytest.mark.asyncio
-    async def test_error_handling_and_recovery(self, mock_exchange):
+    async def test_error_handling_and_recovery(self, mock_exchange, fake_ccxt):
         """Тестирует обработку ошибок и восстановление"""
         service = ExchangeService()
 
-        with patch('ccxt.binance') as mock_binance_class:
-            mock_instance = Mock()
-            # Первый вызов - ошибка, второй - успех
-            mock_instance.fetch_ohlcv = Mock(side_effect=[
-                Exception("Network error"),
-                [[1672574400000, 50000.0, 51000.0, 49000.0, 50500.0, 100.5]]
-            ])
-            mock_binance_class.return_value = mock_instance
+        # Первый вызов - ошибка, второй - успех
+        fake_ccxt.binance.return_value.fetch_ohlcv = Mock(side_effect=[
+            Exception("Network error"),
+            [list(BASE_OHLCV_ROW)]
+        ])
 
-            exchange_instance = service.get_exchange_instance(mock_exchange)
+        exchange_instance = service.get_exchange_instance(mock_exchange)
 
-            # Первый вызов - должен вернуть None из-за ошибки
-            result1 = await service.fetch_current_candle(exchange_instance, "BTC/USDT", "1m")
-            assert result1 is None
+        # Первый вызов - должен вернуть None из-за ошибки
+        result1 = await service.fetch_current_candle(exchange_instance, "BTC/USDT", "1m")
+        assert result1 is None
 
-            # Второй вызов - должен быть успешным
-            result2 = await service.fetch_current_candle(exchange_instance, "BTC/USDT", "1m")
-            assert result2 is not None
-            assert math.isclose(result2['open'], 50000.0, rel_tol=1e-9)
+        # Второй вызов - должен быть успешным
+        result2 = await service.fetch_current_candle(exchange_instance, "BTC/USDT", "1m")
+        assert result2 is not None
+        assert result2['open'] == 50000.0
 
 
 # Тесты производительности (можно запускать отдельно)
 class TestExchangeServicePerformance:
     """Тесты производительности для проверки скорости работы сервиса"""
 
-    @pytest.mark.asyncio
     @pytest.mark.slow
-    async def test_large_historical_data_processing(self):
+    async def test_large_historical_data_processing(self, service, large_ohlcv,
+                                                    mock_exchange_instance):
         """Тестирует обработку большого объема исторических данных"""
-        service = ExchangeService()
-
-        # Создаем большой массив данных (1000 свечей)
-        large_data = []
-        base_timestamp = 1672574400000
-        for i in range(1000):
-            large_data.append([
-                base_timestamp + i * 60000,  # +1 минута для каждой свечи
-                50000.0 + i, 51000.0 + i, 49000.0 + i, 50500.0 + i, 100.5
-            ])
+        mock_exchange_instance.fetch_ohlcv.return_value = large_ohlcv
 
-        mock_exchange_instance = Mock()
-        mock_exchange_instance.fetch_ohlcv = Mock(return_value=large_data)
-
-        start_time = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
         result = await service.fetch_historical_candles(
-            mock_exchange_instance, "BTC/USDT", "1m", start_time
+            mock_exchange_instance, "BTC/USDT", "1m", BASE_TIME
         )
 
         assert len(result) == 1000
-        assert all('timestamp' in candle for candle in result)
-        assert all(isinstance(candle['timestamp'], datetime) for candle in result)
+        assert all(isinstance(candle.get('timestamp'), datetime) for candle in result)
 
-    def test_exchange_instance_caching_performance(self):
-        """Тестирует производительность кэширования экземпляров бирж"""
+    def test_exchange_instance_caching_performance(self, fake_ccxt):
+        """Тестирует что повторные запросы биржи обслуживаются из кэша"""
         service = ExchangeService()
 
         exchange = models.Exchange(
@@ -528,19 +449,34 @@ class TestExchangeServicePerformance:
             environment="sandbox", api_key="key", api_secret="secret", is_active=True
         )
 
-        with patch('ccxt.binance') as mock_binance_class:
-            mock_instance = Mock()
-            mock_binance_class.return_value = mock_instance
+        first = service.get_exchange_instance(exchange)
+        second = service.get_exchange_instance(exchange)
+
+        # Второй вызов возвращает тот же экземпляр из кэша
+        assert first is second is fake_ccxt.binance.return_value
+        # ccxt.binance должен быть вызван только один раз
+        assert fake_ccxt.binance.call_count == 1
+
+    @pytest.mark.benchmark
+    def test_exchange_instance_cache_lookup_benchmark(self, benchmark, fake_ccxt):
+        """
+        Измеряет время получения биржи из кэша.
+
+        Под xdist pytest-benchmark отключает замеры и выполняет функцию
+        один раз; для замеров: make test-benchmark (pytest -n0 -m benchmark).
+        """
+        service = ExchangeService()
+
+        exchange = models.Exchange(
+            id=1, name="Binance", code="binance",
+            environment="sandbox", api_key="key", api_secret="secret", is_active=True
+        )
+        service.get_exchange_instance(exchange)  # Заполняем кэш
 
-            # Множественные вызовы должны использовать кэш
-            instances = []
-            for _ in range(100):
-                instances.append(service.get_exchange_instance(exchange))
+        result = benchmark(service.get_exchange_instance, exchange)
 
-            # Все экземпляры должны быть одинаковыми (из кэша)
-            assert all(inst == mock_instance for inst in instances)
-            # ccxt.binance должен быть вызван только один раз
-            assert mock_binance_class.call_count == 1
+        assert result is fake_ccxt.binance.return_value
+        assert fake_ccxt.binance.call_count == 1
 
 
 if __name__ == "__main__":
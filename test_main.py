@@ -4,31 +4,36 @@
 Содержит тесты для всех эндпоинтов API и проверку их корректной работы.
 """
 from datetime import datetime, timezone
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
 
 import models
-from main import app, get_db
+from main import HealthShortcut, app, get_db
 from database import get_engine  # Используем тестовое приложение БЕЗ планировщика
 
 
-@pytest.fixture
-def client(test_db_session, test_db_engine, mock_data_collection_service):
-    """Создает тестовый клиент FastAPI с тестовой БД"""
-    def override_get_db():
-        try:
-            yield test_db_session
-        finally:
-            test_db_session.close()
-
-    def override_get_engine():
-        return test_db_engine
-
-    # Переопределяем dependency functions
-    app.dependency_overrides[get_db] = override_get_db
-    app.dependency_overrides[get_engine] = override_get_engine
+@pytest.fixture(scope="module")
+def app_client(db_engine, mock_data_collection_service):
+    """
+    Создает тестовый клиент FastAPI один раз на модуль.
+
+    Старт приложения (lifespan) выполняется однократно, сессия БД
+    подменяется для каждого теста фикстурой client.
+    """
+    # /db-status открывает собственное соединение, а единственное соединение
+    # db_engine занято транзакцией теста. Второй движок подключается к той же
+    # именованной БД в памяти (shared cache) и видит ту же схему.
+    status_engine = create_engine(
+        db_engine.url,
+        connect_args={"check_same_thread": False},
+        poolclass=NullPool
+    )
+    app.dependency_overrides[get_engine] = lambda: status_engine
 
     # Мокируем data_collection_service в main модуле
     with patch('main.data_collection_service', mock_data_collection_service):
@@ -36,10 +41,18 @@ def client(test_db_session, test_db_engine, mock_data_collection_service):
             yield test_client
 
     app.dependency_overrides.clear()
+    status_engine.dispose()
 
 
 @pytest.fixture
-def populated_test_db(test_db_session):
+def client(app_client, test_db):
+    """Тестовый клиент, работающий с транзакционной сессией текущего теста"""
+    app.dependency_overrides[get_db] = lambda: test_db
+    yield app_client
+    del app.dependency_overrides[get_db]
+
+
+def populate_test_db(test_db):
     """Заполняет тестовую БД тестовыми данными"""
     # Создаем биржу
     exchange = models.Exchange(
@@ -53,13 +66,10 @@ def populated_test_db(test_db_session):
     btc = models.Symbol(name="Bitcoin", symbol="BTC", is_active=True)
     usdt = models.Symbol(name="Tether", symbol="USDT", is_active=True)
 
-    # Создаем валютную пару
-    test_db_session.add_all([exchange, btc, usdt])
-    test_db_session.commit()
-
+    # Создаем валютную пару (id символов проставятся при flush)
     pair = models.CurrencyPair(
-        base_symbol_id=btc.id,
-        quote_symbol_id=usdt.id,
+        base_symbol=btc,
+        quote_symbol=usdt,
         type="spot",
         is_active=True
     )
@@ -71,19 +81,17 @@ def populated_test_db(test_db_session):
         is_active=True
     )
 
-    test_db_session.add_all([pair, period])
-    test_db_session.commit()
+    test_db.add_all([exchange, btc, usdt, pair, period])
+    test_db.flush()
 
-    # Создаем тестовые свечи
-    candles = []
-    for i in range(5):
-        timestamp = datetime(2023, 1, 1, 12, i, tzinfo=timezone.utc)
-        candle = models.Candle(
+    # Создаем тестовые свечи без отслеживания состояния в сессии
+    test_db.bulk_save_objects([
+        models.Candle(
             currency_pair_id=pair.id,
             exchange_id=exchange.id,
             time_period_id=period.id,
-            open_time=timestamp,
-            close_time=timestamp,
+            open_time=datetime(2023, 1, 1, 12, i, tzinfo=timezone.utc),
+            close_time=datetime(2023, 1, 1, 12, i, tzinfo=timezone.utc),
             open_price=50000.0 + i * 100,
             high_price=51000.0 + i * 100,
             low_price=49000.0 + i * 100,
@@ -92,16 +100,41 @@ def populated_test_db(test_db_session):
             quote_volume=0,
             trades_count=0
         )
-        candles.append(candle)
-
-    test_db_session.add_all(candles)
-    test_db_session.commit()
-
-    return test_db_session
+        for i in range(5)
+    ])
+    test_db.commit()
 
 
 class TestMainAPI:
-    """Тесты для основных эндпоинтов API"""
+    """
+    Тесты для основных эндпоинтов API.
+
+    Тестовые данные создаются один раз на класс во внешней транзакции,
+    каждый тест работает в своем SAVEPOINT поверх них.
+    """
+
+    @pytest.fixture(scope="class")
+    def populated_connection(self, db_engine):
+        """Соединение с заполненной БД, откатываемое после тестов класса"""
+        connection = db_engine.connect()
+        transaction = connection.begin()
+        session = Session(bind=connection, join_transaction_mode="create_savepoint")
+        populate_test_db(session)
+        session.close()
+        yield connection
+        transaction.rollback()
+        connection.close()
+
+    @pytest.fixture
+    def test_db(self, populated_connection):
+        """Сессия теста поверх общих данных класса"""
+        session = Session(
+            bind=populated_connection,
+            autoflush=False,
+            join_transaction_mode="create_savepoint"
+        )
+        yield session
+        session.close()
 
     def test_read_root_without_static_file(self, client):
         """Тестирует корневой endpoint без статического файла"""
@@ -156,7 +189,7 @@ class TestMainAPI:
         assert json_response["status"] == "success"
         assert "Historical candles collection triggered" in json_response["message"]
 
-    def test_stats_success(self, client, populated_test_db):
+    def test_stats_success(self, client):
         """Тестирует успешное получение статистики"""
         response = client.get("/stats")
         assert response.status_code == 200
@@ -173,6 +206,14 @@ class TestMainAPI:
         assert json_response["total_currency_pairs"] == 1
         assert json_response["total_time_periods"] == 1
 
+        latest_update = json_response["latest_updates"][0]
+        assert latest_update["exchange"] == "Test Exchange"
+        assert datetime.fromisoformat(latest_update["last_update"])
+
+
+class TestStatsEmptyDatabase:
+    """Тесты статистики на пустой БД (без общих данных TestMainAPI)"""
+
     def test_stats_with_empty_database(self, client):
         """Тестирует получение статистики с пустой БД"""
         response = client.get("/stats")
@@ -186,31 +227,79 @@ class TestMainAPI:
         assert json_response["latest_updates"] == []
 
 
+class TestHealthShortcut:
+    """Тесты middleware HealthShortcut, отвечающего на /health до FastAPI"""
+
+    @staticmethod
+    async def call_shortcut(method):
+        """Пропускает запрос к /health через middleware, возвращает (app, сообщения)"""
+        inner_app = AsyncMock()
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": method, "path": "/health"}
+        await HealthShortcut(inner_app)(scope, AsyncMock(), send)
+        return inner_app, sent
+
+    async def test_get_answered_without_app(self):
+        """GET /health отвечает сам, приложение не вызывается"""
+        inner_app, sent = await self.call_shortcut("GET")
+
+        inner_app.assert_not_awaited()
+        assert sent[0]["status"] == 200
+        assert sent[1]["body"] == HealthShortcut.BODY
+
+    async def test_head_has_no_body(self):
+        """HEAD /health отдает только заголовки"""
+        inner_app, sent = await self.call_shortcut("HEAD")
+
+        inner_app.assert_not_awaited()
+        assert sent[0]["status"] == 200
+        assert sent[1]["body"] == b""
+
+    @pytest.mark.parametrize("method", ["POST", "DELETE", "OPTIONS"])
+    async def test_other_methods_passed_to_app(self, method):
+        """Остальные методы обрабатываются приложением"""
+        inner_app, sent = await self.call_shortcut(method)
+
+        inner_app.assert_awaited_once()
+        assert sent == []
+
+    @pytest.mark.parametrize("method", ["post", "delete"])
+    def test_unsupported_method_not_allowed(self, client, method):
+        """POST/DELETE /health по-прежнему получают 405 от FastAPI"""
+        response = getattr(client, method)("/health")
+        assert response.status_code == 405
+
+    def test_cors_preflight(self, client):
+        """CORS preflight к /health обрабатывается CORSMiddleware"""
+        response = client.options("/health", headers={
+            "Origin": "http://example.com",
+            "Access-Control-Request-Method": "GET",
+        })
+        assert response.status_code == 200
+        assert "access-control-allow-origin" in response.headers
+
+
 # Интеграционные тесты
 class TestAPIIntegration:
     """Интеграционные тесты для проверки совместной работы компонентов"""
 
-    def test_api_health_check_sequence(self, client):
-        """Интеграционный тест: последовательность проверок здоровья API"""
-        # Проверяем основные endpoints в последовательности
-        endpoints = ["/health", "/api", "/db-status", "/data-collection-status"]
+    @pytest.mark.parametrize("endpoint", ["/health", "/api", "/db-status", "/data-collection-status"])
+    def test_api_health_check(self, client, endpoint):
+        """Интеграционный тест: эндпоинты проверки здоровья API"""
+        response = client.get(endpoint)
+        assert response.status_code == 200
+        assert response.json() is not None
 
-        for endpoint in endpoints:
-            response = client.get(endpoint)
-            assert response.status_code == 200
-            assert response.json() is not None
-
-    def test_trigger_endpoints_sequence(self, client):
-        """Интеграционный тест: последовательность ручных запусков"""
-        # Запускаем сбор текущих данных
-        response1 = client.post("/trigger-current-collection")
-        assert response1.status_code == 200
-        assert response1.json()["status"] == "success"
-
-        # Запускаем сбор исторических данных
-        response2 = client.post("/trigger-historical-collection")
-        assert response2.status_code == 200
-        assert response2.json()["status"] == "success"
+    @pytest.mark.parametrize("endpoint", ["/trigger-current-collection", "/trigger-historical-collection"])
+    def test_trigger_endpoints(self, client, endpoint):
+        """Интеграционный тест: ручные запуски сбора данных"""
+        response = client.post(endpoint)
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
 
 
 if __name__ == "__main__":
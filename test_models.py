@@ -4,25 +4,45 @@
 Этот модуль содержит тесты для всех моделей SQLAlchemy,
 включая тесты создания, валидации, связей и ограничений.
 """
-import math
 from datetime import datetime, timezone
+from decimal import Decimal
+from types import SimpleNamespace
 
 import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func, insert, select
 from sqlalchemy.exc import IntegrityError
 
 import models
-from database import Base
+
+BASE_TIME = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
 
 
 @pytest.fixture
-def test_db():
-    """Создает тестовую базу данных в памяти"""
-    engine = create_engine("sqlite:///:memory:", echo=False)
-    Base.metadata.create_all(engine)
-    testing_session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    return testing_session_local()
+def trading_ctx(request, test_db):
+    """
+    Создает биржу, период, символы и валютную пару для тестов свечей.
+
+    Название биржи, период и базовый символ можно переопределить через
+    косвенную параметризацию (indirect) словарем.
+    """
+    params = getattr(request, "param", {})
+    exchange_name, exchange_code = params.get("exchange", ("Test Exchange", "test"))
+    period_name, period_minutes = params.get("period", ("1m", 1))
+    base_name, base_code = params.get("base", ("Bitcoin", "BTC"))
+
+    exchange = models.Exchange(name=exchange_name, code=exchange_code, environment="test")
+    period = models.TimePeriod(name=period_name, minutes=period_minutes)
+    base = models.Symbol(name=base_name, symbol=base_code)
+    usdt = models.Symbol(name="Tether", symbol="USDT")
+
+    test_db.add_all([exchange, period, base, usdt])
+    test_db.flush()
+
+    pair = models.CurrencyPair(base_symbol_id=base.id, quote_symbol_id=usdt.id, type="spot")
+    test_db.add(pair)
+    test_db.flush()
+
+    return SimpleNamespace(exchange=exchange, period=period, base=base, usdt=usdt, pair=pair)
 
 
 class TestUserModel:
@@ -39,7 +59,7 @@ class TestUserModel:
         test_db.add(user)
         test_db.commit()
 
-        saved_user = test_db.query(models.User).first()
+        saved_user = test_db.get(models.User, user.id)
         assert saved_user.name == "Test User"
         assert saved_user.email == "test@example.com"
         assert saved_user.password == "hashed_password"
@@ -69,27 +89,19 @@ class TestUserModel:
 
     def test_user_required_fields(self, test_db):
         """Тестирует обязательные поля пользователя"""
-        # Без name
-        with pytest.raises(IntegrityError):
-            user = models.User(email="test@example.com", password="password")
-            test_db.add(user)
-            test_db.commit()
-
-        test_db.rollback()
+        cases = [
+            {"email": "test@example.com", "password": "password"},  # Без name
+            {"name": "Test User", "password": "password"},  # Без email
+            {"name": "Test User", "email": "test@example.com"},  # Без password
+        ]
 
-        # Без email
-        with pytest.raises(IntegrityError):
-            user = models.User(name="Test User", password="password")
-            test_db.add(user)
-            test_db.commit()
+        for fields in cases:
+            # Ошибка откатывает только SAVEPOINT, транзакция теста продолжается
+            with pytest.raises(IntegrityError):
+                with test_db.begin_nested():
+                    test_db.execute(insert(models.User).values(**fields))
 
-        test_db.rollback()
-
-        # Без password
-        with pytest.raises(IntegrityError):
-            user = models.User(name="Test User", email="test@example.com")
-            test_db.add(user)
-            test_db.commit()
+        assert test_db.query(models.User).count() == 0
 
 
 class TestExchangeModel:
@@ -109,7 +121,7 @@ class TestExchangeModel:
         test_db.add(exchange)
         test_db.commit()
 
-        saved_exchange = test_db.query(models.Exchange).first()
+        saved_exchange = test_db.get(models.Exchange, exchange.id)
         assert saved_exchange.name == "Binance"
         assert saved_exchange.code == "binance"
         assert saved_exchange.environment == "production"
@@ -130,7 +142,7 @@ class TestExchangeModel:
         test_db.add(exchange)
         test_db.commit()
 
-        saved_exchange = test_db.query(models.Exchange).first()
+        saved_exchange = test_db.get(models.Exchange, exchange.id)
         assert saved_exchange.api_passphrase == "test_passphrase"
 
     def test_exchange_default_values(self, test_db):
@@ -144,7 +156,7 @@ class TestExchangeModel:
         test_db.add(exchange)
         test_db.commit()
 
-        saved_exchange = test_db.query(models.Exchange).first()
+        saved_exchange = test_db.get(models.Exchange, exchange.id)
         assert saved_exchange.is_active is True  # Значение по умолчанию
 
 
@@ -162,7 +174,7 @@ class TestSymbolModel:
         test_db.add(symbol)
         test_db.commit()
 
-        saved_symbol = test_db.query(models.Symbol).first()
+        saved_symbol = test_db.get(models.Symbol, symbol.id)
         assert saved_symbol.name == "Bitcoin"
         assert saved_symbol.symbol == "BTC"
         assert saved_symbol.description == "Bitcoin cryptocurrency"
@@ -203,33 +215,15 @@ class TestCurrencyPairModel:
         test_db.add(pair)
         test_db.commit()
 
-        saved_pair = test_db.query(models.CurrencyPair).first()
+        saved_pair = test_db.get(models.CurrencyPair, pair.id)
         assert saved_pair.base_symbol_id == btc.id
         assert saved_pair.quote_symbol_id == usdt.id
         assert saved_pair.type == "spot"
         assert saved_pair.is_active is True
 
-    def test_currency_pair_relationships(self, test_db):
+    def test_currency_pair_relationships(self, test_db, trading_ctx):
         """Тестирует связи валютной пары с символами"""
-        # Создаем символы
-        btc = models.Symbol(name="Bitcoin", symbol="BTC")
-        usdt = models.Symbol(name="Tether", symbol="USDT")
-
-        test_db.add_all([btc, usdt])
-        test_db.commit()
-
-        # Создаем валютную пару
-        pair = models.CurrencyPair(
-            base_symbol_id=btc.id,
-            quote_symbol_id=usdt.id,
-            type="futures"
-        )
-
-        test_db.add(pair)
-        test_db.commit()
-
-        # Проверяем связи
-        saved_pair = test_db.query(models.CurrencyPair).first()
+        saved_pair = test_db.get(models.CurrencyPair, trading_ctx.pair.id)
         assert saved_pair.base_symbol.symbol == "BTC"
         assert saved_pair.quote_symbol.symbol == "USDT"
 
@@ -248,7 +242,7 @@ class TestTimePeriodModel:
         test_db.add(period)
         test_db.commit()
 
-        saved_period = test_db.query(models.TimePeriod).first()
+        saved_period = test_db.get(models.TimePeriod, period.id)
         assert saved_period.name == "1 minute"
         assert saved_period.minutes == 1
         assert saved_period.description == "One minute timeframe"
@@ -256,14 +250,12 @@ class TestTimePeriodModel:
 
     def test_multiple_time_periods(self, test_db):
         """Тестирует создание нескольких периодов времени"""
-        periods = [
-            models.TimePeriod(name="1 minute", minutes=1),
-            models.TimePeriod(name="5 minutes", minutes=5),
-            models.TimePeriod(name="1 hour", minutes=60),
-            models.TimePeriod(name="1 day", minutes=1440)
-        ]
-
-        test_db.add_all(periods)
+        test_db.execute(insert(models.TimePeriod), [
+            {"name": "1 minute", "minutes": 1},
+            {"name": "5 minutes", "minutes": 5},
+            {"name": "1 hour", "minutes": 60},
+            {"name": "1 day", "minutes": 1440}
+        ])
         test_db.commit()
 
         saved_periods = test_db.query(models.TimePeriod).all()
@@ -279,155 +271,57 @@ class TestTimePeriodModel:
 class TestCandleModel:
     """Тесты для модели Candle."""
 
-    def test_create_candle(self, test_db):
-        """Тестирует создание свечи"""
-        # Создаем зависимые объекты
-        exchange = models.Exchange(name="Binance", code="binance", environment="production")
-        period = models.TimePeriod(name="1 minute", minutes=1)
-
-        # Создаем символы
-        btc = models.Symbol(name="Bitcoin", symbol="BTC")
-        usdt = models.Symbol(name="Tether", symbol="USDT")
-
-        test_db.add_all([exchange, period, btc, usdt])
-        test_db.commit()
-
-        # Создаем валютную пару
-        currency_pair = models.CurrencyPair(
-            base_symbol_id=btc.id,
-            quote_symbol_id=usdt.id,
-            type="spot"
-        )
-
-        test_db.add(currency_pair)
-        test_db.commit()
+    @pytest.mark.parametrize("trading_ctx, prices", [
+        ({"exchange": ("Binance", "binance"), "period": ("1 minute", 1)},
+         ("50000.0", "51000.0", "49000.0", "50500.0", "100.5")),
+        ({"exchange": ("OKX", "okx"), "period": ("5 minutes", 5), "base": ("Ethereum", "ETH")},
+         ("3000.0", "3100.0", "2950.0", "3050.0", "250.7")),
+        # Цены с максимальной точностью (8 знаков после запятой)
+        ({"exchange": ("Test", "test")},
+         ("50000.12345678", "51000.87654321", "49000.11111111", "50500.99999999", "100.12345678")),
+    ], ids=["basic", "relationships", "precision"], indirect=["trading_ctx"])
+    def test_candle(self, test_db, trading_ctx, prices):
+        """Тестирует создание свечи, ее связи и точность численных полей"""
+        currency_pair = trading_ctx.pair
 
         # Создаем свечу
-        timestamp = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
+        open_price, high_price, low_price, close_price, volume = map(Decimal, prices)
         candle = models.Candle(
             currency_pair_id=currency_pair.id,
-            exchange_id=exchange.id,
-            time_period_id=period.id,
-            open_time=timestamp,
-            close_time=timestamp,
-            open_price=50000.0,
-            high_price=51000.0,
-            low_price=49000.0,
-            close_price=50500.0,
-            volume=100.5,
+            exchange_id=trading_ctx.exchange.id,
+            time_period_id=trading_ctx.period.id,
+            open_time=BASE_TIME,
+            close_time=BASE_TIME,
+            open_price=open_price,
+            high_price=high_price,
+            low_price=low_price,
+            close_price=close_price,
+            volume=volume,
             quote_volume=0,
             trades_count=0
         )
 
         test_db.add(candle)
         test_db.commit()
+        # Проверяем значения, прочитанные из БД, а не переданные в конструктор
+        test_db.expire(candle)
 
-        saved_candle = test_db.query(models.Candle).first()
+        saved_candle = test_db.get(models.Candle, candle.id)
         assert saved_candle.currency_pair_id == currency_pair.id
-        assert math.isclose(float(saved_candle.open_price), 50000.0, rel_tol=1e-9)
-        assert math.isclose(float(saved_candle.high_price), 51000.0, rel_tol=1e-9)
-        assert math.isclose(float(saved_candle.low_price), 49000.0, rel_tol=1e-9)
-        assert math.isclose(float(saved_candle.close_price), 50500.0, rel_tol=1e-9)
-        assert math.isclose(float(saved_candle.volume), 100.5, rel_tol=1e-9)
         assert saved_candle.open_time.year == 2023
 
-    def test_candle_relationships(self, test_db):
-        """Тестирует связи свечи с биржей и периодом"""
-        # Создаем зависимые объекты
-        exchange = models.Exchange(name="OKX", code="okx", environment="sandbox")
-        period = models.TimePeriod(name="5 minutes", minutes=5)
-
-        # Создаем символы
-        eth = models.Symbol(name="Ethereum", symbol="ETH")
-        usdt = models.Symbol(name="Tether", symbol="USDT")
-
-        test_db.add_all([exchange, period, eth, usdt])
-        test_db.commit()
-
-        # Создаем валютную пару
-        currency_pair = models.CurrencyPair(
-            base_symbol_id=eth.id,
-            quote_symbol_id=usdt.id,
-            type="spot"
-        )
-
-        test_db.add(currency_pair)
-        test_db.commit()
-
-        # Создаем свечу
-        timestamp = datetime(2023, 1, 1, 12, 5, tzinfo=timezone.utc)
-        candle = models.Candle(
-            currency_pair_id=currency_pair.id,
-            exchange_id=exchange.id,
-            time_period_id=period.id,
-            open_time=timestamp,
-            close_time=timestamp,
-            open_price=3000.0,
-            high_price=3100.0,
-            low_price=2950.0,
-            close_price=3050.0,
-            volume=250.7,
-            quote_volume=0,
-            trades_count=0
-        )
-
-        test_db.add(candle)
-        test_db.commit()
+        # Проверяем что точность сохранена (до 8 знаков после запятой)
+        saved_values = (saved_candle.open_price, saved_candle.high_price,
+                        saved_candle.low_price, saved_candle.close_price,
+                        saved_candle.volume)
+        assert saved_values == (open_price, high_price, low_price, close_price, volume)
 
         # Проверяем связи
-        saved_candle = test_db.query(models.Candle).first()
-        assert saved_candle.exchange.name == "OKX"
-        assert saved_candle.time_period.name == "5 minutes"
-        assert saved_candle.currency_pair.base_symbol.symbol == "ETH"
+        assert saved_candle.exchange.name == trading_ctx.exchange.name
+        assert saved_candle.time_period.name == trading_ctx.period.name
+        assert saved_candle.currency_pair.base_symbol.symbol == trading_ctx.base.symbol
         assert saved_candle.currency_pair.quote_symbol.symbol == "USDT"
 
-    def test_candle_precision(self, test_db):
-        """Тестирует точность численных полей свечи"""
-        exchange = models.Exchange(name="Test", code="test", environment="test")
-        period = models.TimePeriod(name="1m", minutes=1)
-
-        # Создаем символы
-        btc = models.Symbol(name="Bitcoin", symbol="BTC")
-        usdt = models.Symbol(name="Tether", symbol="USDT")
-
-        test_db.add_all([exchange, period, btc, usdt])
-        test_db.commit()
-
-        # Создаем валютную пару
-        currency_pair = models.CurrencyPair(
-            base_symbol_id=btc.id,
-            quote_symbol_id=usdt.id,
-            type="spot"
-        )
-
-        test_db.add(currency_pair)
-        test_db.commit()
-
-        # Создаем свечу с высокой точностью
-        timestamp = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
-        candle = models.Candle(
-            currency_pair_id=currency_pair.id,
-            exchange_id=exchange.id,
-            time_period_id=period.id,
-            open_time=timestamp,
-            close_time=timestamp,
-            open_price=50000.12345678,
-            high_price=51000.87654321,
-            low_price=49000.11111111,
-            close_price=50500.99999999,
-            volume=100.12345678,
-            quote_volume=0,
-            trades_count=0
-        )
-
-        test_db.add(candle)
-        test_db.commit()
-
-        saved_candle = test_db.query(models.Candle).first()
-        # Проверяем что точность сохранена (до 8 знаков после запятой)
-        assert str(saved_candle.open_price) == "50000.12345678"
-        assert str(saved_candle.volume) == "100.12345678"
-
 
 class TestExchangeConfigurationModel:
     """Тесты для модели ExchangeConfiguration."""
@@ -453,7 +347,7 @@ class TestExchangeConfigurationModel:
         test_db.add(config)
         test_db.commit()
 
-        saved_config = test_db.query(models.ExchangeConfiguration).first()
+        saved_config = test_db.get(models.ExchangeConfiguration, config.id)
         assert saved_config.api_key == "user_api_key"
         assert saved_config.api_secret == "user_api_secret"
         assert saved_config.sandbox_mode is True
@@ -479,7 +373,7 @@ class TestExchangeConfigurationModel:
         test_db.commit()
 
         # Проверяем связи
-        saved_config = test_db.query(models.ExchangeConfiguration).first()
+        saved_config = test_db.get(models.ExchangeConfiguration, config.id)
         assert saved_config.exchange.name == "OKX"
         assert saved_config.user.name == "John Doe"
 
@@ -499,7 +393,7 @@ class TestExchangeConfigurationModel:
         test_db.add(config)
         test_db.commit()
 
-        saved_config = test_db.query(models.ExchangeConfiguration).first()
+        saved_config = test_db.get(models.ExchangeConfiguration, config.id)
         assert saved_config.sandbox_mode is False  # Значение по умолчанию
 
 
@@ -536,24 +430,25 @@ class TestModelsIntegration:
             type="spot"
         )
 
-        # Создаем периоды времени
-        periods = [
-            models.TimePeriod(name="1m", minutes=1),
-            models.TimePeriod(name="5m", minutes=5),
-            models.TimePeriod(name="1h", minutes=60)
-        ]
-
         # Добавляем все в базу
         test_db.add_all([user, exchange, btc, usdt])
-        test_db.commit()
+        test_db.flush()
 
         # Устанавливаем правильные ID для валютной пары
         pair.base_symbol_id = btc.id
         pair.quote_symbol_id = usdt.id
 
         test_db.add(pair)
-        test_db.add_all(periods)
-        test_db.commit()
+        # Периоды - листовая таблица, ORM-объекты для них не нужны
+        test_db.bulk_insert_mappings(models.TimePeriod, [
+            {"name": "1m", "minutes": 1},
+            {"name": "5m", "minutes": 5},
+            {"name": "1h", "minutes": 60}
+        ])
+        test_db.flush()
+
+        # bulk_insert_mappings не возвращает id - читаем периоды обратно
+        periods = test_db.query(models.TimePeriod).order_by(models.TimePeriod.id).all()
 
         # Создаем конфигурацию пользователя
         user_config = models.ExchangeConfiguration(
@@ -566,40 +461,36 @@ class TestModelsIntegration:
         test_db.add(user_config)
 
         # Создаем свечи для разных периодов
-        base_time = datetime(2023, 1, 1, 12, 0, tzinfo=timezone.utc)
-        candles = []
-
-        for i, period in enumerate(periods):
-            candle = models.Candle(
-                currency_pair_id=pair.id,
-                exchange_id=exchange.id,
-                time_period_id=period.id,
-                open_time=base_time,
-                close_time=base_time,
-                open_price=50000.0 + i * 100,
-                high_price=51000.0 + i * 100,
-                low_price=49000.0 + i * 100,
-                close_price=50500.0 + i * 100,
-                volume=100.0 + i * 10,
-                quote_volume=0,
-                trades_count=0
-            )
-            candles.append(candle)
-
-        test_db.add_all(candles)
-        test_db.commit()
-
-        # Проверяем что все создалось корректно
-        assert test_db.query(models.User).count() == 1
-        assert test_db.query(models.Exchange).count() == 1
-        assert test_db.query(models.Symbol).count() == 2
-        assert test_db.query(models.CurrencyPair).count() == 1
-        assert test_db.query(models.TimePeriod).count() == 3
-        assert test_db.query(models.ExchangeConfiguration).count() == 1
-        assert test_db.query(models.Candle).count() == 3
+        test_db.execute(insert(models.Candle), [
+            {
+                "currency_pair_id": pair.id,
+                "exchange_id": exchange.id,
+                "time_period_id": period.id,
+                "open_time": BASE_TIME,
+                "close_time": BASE_TIME,
+                "open_price": 50000.0 + i * 100,
+                "high_price": 51000.0 + i * 100,
+                "low_price": 49000.0 + i * 100,
+                "close_price": 50500.0 + i * 100,
+                "volume": 100.0 + i * 10,
+                "quote_volume": 0,
+                "trades_count": 0
+            }
+            for i, period in enumerate(periods)
+        ])
+        test_db.commit()
+
+        # Проверяем что все создалось корректно - все счетчики одним запросом
+        counted_models = (models.User, models.Exchange, models.Symbol, models.CurrencyPair,
+                          models.TimePeriod, models.ExchangeConfiguration, models.Candle)
+        counts = test_db.execute(select(*(
+            select(func.count()).select_from(model).scalar_subquery()
+            for model in counted_models
+        ))).one()
+        assert tuple(counts) == (1, 1, 2, 1, 3, 1, 3)
 
         # Проверяем связи
-        saved_pair = test_db.query(models.CurrencyPair).first()
+        saved_pair = test_db.get(models.CurrencyPair, pair.id)
         assert saved_pair.base_symbol.symbol == "BTC"
         assert saved_pair.quote_symbol.symbol == "USDT"
 
@@ -607,61 +498,42 @@ class TestModelsIntegration:
         assert saved_candle.exchange.name == "Binance"
         assert saved_candle.time_period.name == "1m"
 
-    def test_cascade_operations(self, test_db):
+    def test_cascade_operations(self, test_db, trading_ctx):
         """Тестирует каскадные операции (если они настроены)"""
-        # Создаем структуру с зависимостями
-        exchange = models.Exchange(name="Test Exchange", code="test", environment="test")
-        period = models.TimePeriod(name="1m", minutes=1)
-
-        # Создаем символы
-        btc = models.Symbol(name="Bitcoin", symbol="BTC")
-        usdt = models.Symbol(name="Tether", symbol="USDT")
-
-        test_db.add_all([exchange, period, btc, usdt])
-        test_db.commit()
-
-        # Создаем валютную пару
-        currency_pair = models.CurrencyPair(
-            base_symbol_id=btc.id,
-            quote_symbol_id=usdt.id,
-            type="spot"
-        )
-
-        test_db.add(currency_pair)
-        test_db.commit()
-
-        # Создаем несколько свечей
-        candles = [
-            models.Candle(
-                currency_pair_id=currency_pair.id,
-                exchange_id=exchange.id,
-                time_period_id=period.id,
-                open_time=datetime(2023, 1, 1, 12, i, tzinfo=timezone.utc),
-                close_time=datetime(2023, 1, 1, 12, i, tzinfo=timezone.utc),
-                open_price=50000.0,
-                high_price=51000.0,
-                low_price=49000.0,
-                close_price=50500.0,
-                volume=100.0,
-                quote_volume=0,
-                trades_count=0
-            )
+        exchange = trading_ctx.exchange
+
+        # Создаем несколько свечей одним executemany на уровне Core, без ORM
+        test_db.execute(models.Candle.__table__.insert(), [
+            {
+                "currency_pair_id": trading_ctx.pair.id,
+                "exchange_id": exchange.id,
+                "time_period_id": trading_ctx.period.id,
+                "open_time": BASE_TIME.replace(minute=i),
+                "close_time": BASE_TIME.replace(minute=i),
+                "open_price": 50000.0,
+                "high_price": 51000.0,
+                "low_price": 49000.0,
+                "close_price": 50500.0,
+                "volume": 100.0,
+                "quote_volume": 0,
+                "trades_count": 0
+            }
             for i in range(5)
-        ]
-
-        test_db.add_all(candles)
+        ])
         test_db.commit()
 
         assert test_db.query(models.Candle).count() == 5
 
-        # Удаляем биржу
+        # Удалить биржу со свечами нельзя: нет CASCADE DELETE,
+        # а тестовая БД проверяет foreign keys
         test_db.delete(exchange)
-        test_db.commit()
+        with pytest.raises(IntegrityError):
+            test_db.commit()
+
+        test_db.rollback()
 
-        # Свечи все еще должны существовать (нет CASCADE DELETE)
-        # Это зависит от настройки foreign keys
-        # В SQLite без CASCADE DELETE свечи останутся
-        # В production БД с правильными FK constraints они могут удалиться
+        # Свечи все еще существуют
+        assert test_db.query(models.Candle).count() == 5
 
 
 if __name__ == "__main__":